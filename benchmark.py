@@ -0,0 +1,792 @@
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import sdl2
+import skia
+
+import browser
+import server
+
+SUBRESOURCES = ["/index.js", "/comment.js", "/eventloop.js",
+                "/example13-opacity-raf.js"] * 6
+
+
+SERVER_ORIGIN = None
+
+
+def start_server():
+    global SERVER_ORIGIN
+    if SERVER_ORIGIN:
+        return SERVER_ORIGIN
+
+    s = socket.socket(
+        family=socket.AF_INET,
+        type=socket.SOCK_STREAM,
+        proto=socket.IPPROTO_TCP
+    )
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # server.py's Content-Security-Policy only allows its own port
+    s.bind(('localhost', server.PORT))
+    s.listen()
+
+    def serve():
+        while True:
+            conx, addr = s.accept()
+            threading.Thread(target=server.handle_connection,
+                             args=(conx,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    server.log_request = lambda method, url, status: None
+    SERVER_ORIGIN = "http://localhost:{}".format(server.PORT)
+    return SERVER_ORIGIN
+
+
+SERVER_DO_REQUEST = server.do_request
+
+
+def add_pages(pages, delay=0):
+    do_request = SERVER_DO_REQUEST
+
+    def handle(session, method, url, headers, body):
+        time.sleep(delay)
+        if method == "GET" and url in pages:
+            return "200 OK", pages[url]
+        return do_request(session, method, url, headers, body)
+
+    server.do_request = handle
+
+
+def disable_http_cache():
+    browser.HTTP_CACHE = browser.HTTPCache(0, 0, None)
+
+
+def make_browser():
+    browser.USE_GPU = False
+    sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
+    return browser.Browser()
+
+
+def make_tab(b):
+    tab = browser.Tab(b)
+    b.lock.acquire(blocking=True)
+    b.tabs.append(tab)
+    b.lock.release()
+    return tab
+
+
+def load_and_wait(b, tab, url):
+    # Keep animation frames coming like the main loop does until the
+    # load finishes; only the tab's side of rendering is measured
+    count = tab.measure_load.count
+    b.lock.acquire(blocking=True)
+    b.active_tab = b.tabs.index(tab)
+    tab.task_runner.schedule_task(browser.Task(tab.load, browser.URL(url)))
+    b.lock.release()
+    while tab.measure_load.count == count:
+        b.schedule_animation_frame()
+        time.sleep(0.001)
+
+
+def bench_connection_pool(rounds=20):
+    origin = start_server()
+    disable_http_cache()
+    for keep_alive in [False, True]:
+        browser.HTTP_KEEP_ALIVE = keep_alive
+        browser.CONNECTION_POOL = browser.ConnectionPool()
+        measure = browser.MeasureTime(
+            "page load (keep-alive={})".format(keep_alive))
+        for _ in range(rounds):
+            measure.start()
+            page = browser.URL(origin + "/index.html")
+            page.request(None)
+            for path in SUBRESOURCES:
+                page.resolve(path).request(page)
+            measure.stop()
+        print(measure.text())
+        print(browser.CONNECTION_POOL.text())
+        browser.CONNECTION_POOL.close_all()
+
+
+def subresource_page(count):
+    page = "<!doctype html><html><head>"
+    pages = {}
+    for i in range(count // 2):
+        page += "<link rel=stylesheet href=/bench-{}.css>".format(i)
+        pages["/bench-{}.css".format(i)] = "p {{ color: blue; }}"
+    page += "</head><body><p>Subresources</p>"
+    for i in range(count // 2):
+        page += "<script src=/bench-{}.js></script>".format(i)
+        pages["/bench-{}.js".format(i)] = "var x{} = {};".format(i, i)
+    page += "</body></html>"
+    pages["/bench-subresources"] = page
+    return pages
+
+
+def bench_subresources(count=24, delay=0.02, rounds=5):
+    origin = start_server()
+    disable_http_cache()
+    add_pages(subresource_page(count), delay)
+
+    b = make_browser()
+    for parallel in [1, browser.MAX_PARALLEL_FETCHES]:
+        browser.MAX_PARALLEL_FETCHES = parallel
+        tab = make_tab(b)
+        tab.measure_load.name = "load ({} parallel fetches)".format(parallel)
+        for _ in range(rounds):
+            load_and_wait(b, tab, origin + "/bench-subresources")
+        tab.task_runner.set_needs_quit()
+        print(tab.measure_load.text())
+
+
+def bench_http_cache(count=24, delay=0.02, rounds=5):
+    origin = start_server()
+    add_pages(subresource_page(count), delay)
+    directory = tempfile.mkdtemp()
+
+    b = make_browser()
+    tab = make_tab(b)
+    for name in ["cold", "memory", "disk"]:
+        tab.measure_load = browser.MeasureTime("load ({} cache)".format(name))
+        for _ in range(1 if name == "cold" else rounds):
+            if name != "memory":
+                # A fresh cache only has the on-disk tier to read from
+                browser.HTTP_CACHE.flush()
+                browser.HTTP_CACHE = browser.HTTPCache(
+                    browser.CACHE_MEMORY_BYTES, browser.CACHE_DISK_BYTES,
+                    directory)
+            load_and_wait(b, tab, origin + "/bench-subresources")
+        print(tab.measure_load.text())
+        print(browser.HTTP_CACHE.text())
+    tab.task_runner.set_needs_quit()
+
+
+def bench_streaming(paragraphs=5000, rounds=3):
+    origin = start_server()
+    disable_http_cache()
+    page = "<!doctype html><html><body>"
+    for i in range(paragraphs):
+        page += "<p>Paragraph {} with <b>some</b> text</p>".format(i)
+    page += "</body></html>"
+    add_pages({"/bench-streaming": page})
+
+    b = make_browser()
+    tab = make_tab(b)
+    for _ in range(rounds):
+        load_and_wait(b, tab, origin + "/bench-streaming")
+    tab.task_runner.set_needs_quit()
+    print("Document size: {} bytes".format(len(page)))
+    print(tab.measure_first_paint.text())
+    print(tab.measure_load.text())
+
+
+def synthetic_page(paragraphs):
+    page = "<!doctype html><html><head><title>Synthetic</title>"
+    page += "<link rel=stylesheet href=/index.css></head><body>"
+    for i in range(paragraphs):
+        page += "<div class=entry id=e{}><p>Paragraph {} with <b>bold</b>, " \
+            "<i>italic</i> and <a href=/p{}>a link</a> &amp; more " \
+            "text to wrap.</p><img src=/x.png><br></div>\n".format(i, i, i)
+    page += "</body></html>"
+    return page
+
+
+def bench_parse_throughput(rounds=5):
+    pages = {
+        "synthetic-1mb": synthetic_page(5500),
+        "index.html": open("index.html").read(),
+        "guest-book": server.show_comments({"user": "crashoverride"}),
+    }
+    for name, page in pages.items():
+        repeat = max(1, 1000000 // len(page))
+        measure = browser.MeasureTime("parse " + name)
+        for _ in range(rounds):
+            measure.start()
+            for _ in range(repeat):
+                browser.HTMLParser(page).parse()
+            measure.stop()
+        seconds = measure.total_s / measure.count
+        print(measure.text())
+        print("  {:.2f} MB/s".format(repeat * len(page) / seconds / 1e6))
+
+
+def bench_deep_nesting(depths=(1000, 4000, 16000), rounds=3):
+    for depth in depths:
+        page = "<div>text " * depth + "</div>" * depth
+        measure = browser.MeasureTime("parse depth {}".format(depth))
+        for _ in range(rounds):
+            measure.start()
+            browser.HTMLParser(page).parse()
+            measure.stop()
+        print(measure.text())
+
+
+def bench_preload(paragraphs=5000, subresources=8, delay=0.2, rounds=3):
+    origin = start_server()
+    disable_http_cache()
+    pages = {}
+    page = "<!doctype html><html><body>"
+    for i in range(paragraphs):
+        page += "<p>Paragraph {} with <b>some</b> text</p>".format(i)
+    for i in range(subresources):
+        pages["/bench-preload-{}.js".format(i)] = "var x{} = {};".format(i, i)
+        page += "<script src=/bench-preload-{}.js></script>".format(i)
+    page += "</body></html>"
+    pages["/bench-preload"] = page
+    add_pages(pages, delay)
+
+    b = make_browser()
+    for scanner in [False, True]:
+        browser.PRELOAD_SCANNER = scanner
+        tab = make_tab(b)
+        tab.measure_load.name = "load (preload scanner={})".format(scanner)
+        for _ in range(rounds):
+            load_and_wait(b, tab, origin + "/bench-preload")
+        tab.task_runner.set_needs_quit()
+        print(tab.measure_load.text())
+        print(tab.preload_text())
+    add_pages({})
+
+
+class StyleTab:
+    dark_mode = False
+
+    def set_needs_render(self):
+        pass
+
+
+def bench_memory(paragraphs=20000):
+    page = synthetic_page(paragraphs)
+    with open("browser.css") as f:
+        rules = browser.CSSParser(f.read()).parse()
+    rules = browser.RuleIndex(rules)
+
+    tracemalloc.start()
+    nodes = browser.HTMLParser(page).parse()
+    parsed = tracemalloc.get_traced_memory()[0]
+    browser.style(nodes, rules, StyleTab())
+    styled = tracemalloc.get_traced_memory()[0]
+    document = browser.DocumentLayout(nodes)
+    document.layout(1)
+    laid_out = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    count = len(browser.tree_to_list(nodes, []))
+    print("Nodes: {}".format(count))
+    print("Bytes per node after parse: {:.0f}".format(parsed / count))
+    print("Bytes per node after style: {:.0f}".format(styled / count))
+    print("Bytes per node after layout: {:.0f}".format(laid_out / count))
+
+
+def large_stylesheet(count):
+    tags = ["div", "p", "b", "i", "a", "img", "span", "h1", "li", "ul"]
+    tags += ["custom-{}".format(i) for i in range(90)]
+    sheet = ""
+    for i in range(count):
+        tag = tags[i % len(tags)]
+        if i % 3 == 0:
+            sheet += "div {} {{ color: #{:06x}; }}\n".format(tag, i)
+        elif i % 3 == 1:
+            sheet += "{}:focus {{ outline: 1px solid black; }}\n".format(tag)
+        else:
+            sheet += "{} {{ font-size: {}px; }}\n".format(tag, 10 + i % 10)
+    return sheet
+
+
+def bench_style_rules(paragraphs=2000, rule_count=3000, rounds=3):
+    nodes = browser.HTMLParser(synthetic_page(paragraphs)).parse()
+    with open("browser.css") as f:
+        rules = browser.CSSParser(f.read()).parse()
+    rules += browser.CSSParser(large_stylesheet(rule_count)).parse()
+    count = len(browser.tree_to_list(nodes, []))
+
+    measure = browser.MeasureTime("style")
+    for _ in range(rounds):
+        measure.start()
+        browser.style(nodes, browser.RuleIndex(rules), StyleTab(),
+                      force=True)
+        measure.stop()
+    print("{} nodes, {} rules".format(count, len(rules)))
+    print(measure.text())
+
+
+def deep_page(depth, breadth):
+    branch = "<div><section><ul><li>" * depth + "<p>leaf <a>link</a></p>"
+    branch += "</li></ul></section></div>" * depth
+    return "<!doctype html><html><body>" + branch * breadth + \
+        "</body></html>"
+
+
+def bench_descendant_selectors(depth=25, breadth=20, rounds=3):
+    nodes = browser.HTMLParser(deep_page(depth, breadth)).parse()
+    sheet = ""
+    for tag in ["span", "table", "article", "nav", "em", "code"]:
+        sheet += "div section {} a {{ color: red; }}\n".format(tag)
+        sheet += "{} ul li p a {{ color: blue; }}\n".format(tag)
+        sheet += "body {} li {{ color: green; }}\n".format(tag)
+        sheet += "div {} p {{ font-weight: bold; }}\n".format(tag)
+    sheet += "div section ul li p a { color: orange; }\n"
+    rules = browser.CSSParser(sheet).parse()
+    count = len(browser.tree_to_list(nodes, []))
+
+    measure = browser.MeasureTime("style")
+    for _ in range(rounds):
+        measure.start()
+        browser.style(nodes, browser.RuleIndex(rules), StyleTab(),
+                      force=True)
+        measure.stop()
+    print("{} nodes, depth {}, {} rules".format(count, depth * 4, len(rules)))
+    print(measure.text())
+
+
+def run_on_tab(tab, callback, *args):
+    done = threading.Event()
+
+    def run():
+        callback(*args)
+        done.set()
+
+    tab.task_runner.schedule_task(browser.Task(run))
+    done.wait()
+
+
+def bench_restyle(paragraphs=3000, keystrokes=20):
+    origin = start_server()
+    disable_http_cache()
+    page = synthetic_page(paragraphs).replace("<img src=/x.png>", "")
+    page = page.replace("<body>", "<body><input name=q>", 1)
+    add_pages({"/bench-restyle": page})
+
+    b = make_browser()
+    tab = make_tab(b)
+    load_and_wait(b, tab, origin + "/bench-restyle")
+    run_on_tab(tab, tab.render)
+    run_on_tab(tab, tab.advance_tab)
+    run_on_tab(tab, tab.enter)
+    run_on_tab(tab, tab.render)
+
+    for incremental in [False, True]:
+        tab.measure_style = browser.MeasureTime(
+            "style per keystroke (incremental={})".format(incremental))
+        for _ in range(keystrokes):
+            run_on_tab(tab, tab.key_press, "a")
+            if not incremental:
+                run_on_tab(tab, tab.set_needs_render)
+            run_on_tab(tab, tab.render)
+        print(tab.measure_style.text())
+    tab.task_runner.set_needs_quit()
+
+
+def bench_style_sharing(items=20000, rounds=3):
+    page = "<!doctype html><html><body><ul>"
+    for i in range(items):
+        page += "<li>Item <b>{}</b> of the list</li>".format(i)
+    page += "</ul></body></html>"
+    nodes = browser.HTMLParser(page).parse()
+    with open("browser.css") as f:
+        rules = browser.CSSParser(f.read()).parse()
+
+    measure = browser.MeasureTime("style")
+    for _ in range(rounds):
+        index = browser.RuleIndex(rules)
+        measure.start()
+        browser.style(nodes, index, StyleTab(), force=True)
+        measure.stop()
+    print(measure.text())
+    print(index.text())
+
+
+def bench_css_cache(tabs=8, rule_count=3000):
+    origin = start_server()
+    page = "<!doctype html><html><head>"
+    page += "<link rel=stylesheet href=/bench-css-cache.css></head>"
+    page += "<body><p>Styled</p></body></html>"
+    add_pages({"/bench-css-cache": page,
+               "/bench-css-cache.css": large_stylesheet(rule_count)})
+
+    b = make_browser()
+    for max_rules in [0, browser.MAX_CACHED_CSS_RULES]:
+        browser.CSS_PARSE_CACHE = browser.StyleSheetCache(max_rules)
+        opened = []
+        for _ in range(tabs):
+            tab = make_tab(b)
+            load_and_wait(b, tab, origin + "/bench-css-cache")
+            opened.append(tab)
+        print("{} tabs, max cached rules {}".format(tabs, max_rules))
+        print(browser.CSS_PARSE_CACHE.text())
+        for tab in opened:
+            tab.task_runner.set_needs_quit()
+
+
+def text_page(paragraphs):
+    words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+             "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+    page = "<!doctype html><html><body>"
+    for i in range(paragraphs):
+        text = " ".join(words[(i + j) % len(words)] for j in range(60))
+        page += "<p>{} <b>bold {}</b> <i>italic</i></p>".format(text, i)
+    return page + "</body></html>"
+
+
+def bench_layout_text(paragraphs=500, rounds=3):
+    nodes = browser.HTMLParser(text_page(paragraphs)).parse()
+    with open("browser.css") as f:
+        rules = browser.CSSParser(f.read()).parse()
+    browser.style(nodes, browser.RuleIndex(rules), StyleTab(), force=True)
+
+    for zoom in [1, 1.1, 1]:
+        measure = browser.MeasureTime("layout (zoom={})".format(zoom))
+        for _ in range(rounds):
+            measure.start()
+            browser.DocumentLayout(nodes).layout(zoom)
+            measure.stop()
+        print(measure.text())
+
+
+def bench_chrome_raster(rounds=100):
+    b = make_browser()
+    tab = make_tab(b)
+    tab.url = browser.URL("http://localhost:8000/")
+    b.active_tab = b.tabs.index(tab)
+    measure = browser.MeasureTime("chrome raster")
+    for _ in range(rounds):
+        measure.start()
+        b.raster_chrome()
+        measure.stop()
+    print(measure.text())
+
+
+def bench_relayout(paragraphs=1000, frames=20):
+    origin = start_server()
+    disable_http_cache()
+    add_pages({"/bench-relayout": text_page(paragraphs)})
+
+    b = make_browser()
+    tab = make_tab(b)
+    load_and_wait(b, tab, origin + "/bench-relayout")
+    run_on_tab(tab, tab.render)
+    paragraphs = [node for node in browser.tree_to_list(tab.nodes, [])
+                  if isinstance(node, browser.Element) and node.tag == "p"]
+    target = paragraphs[len(paragraphs) // 2]
+
+    def resize(size, incremental):
+        target.attributes["style"] = "font-size:{}px".format(size)
+        tab.set_needs_style(target)
+        if not incremental:
+            tab.document = None
+        tab.render()
+
+    for incremental in [False, True]:
+        tab.measure_layout = browser.MeasureTime(
+            "layout per change (incremental={})".format(incremental))
+        for i in range(frames):
+            run_on_tab(tab, resize, 16 + 4 * (i % 2), incremental)
+        print(tab.measure_layout.text())
+    tab.task_runner.set_needs_quit()
+
+
+def bench_lazy_layout(sizes=(1000, 4000), rounds=3):
+    with open("browser.css") as f:
+        rules = browser.RuleIndex(browser.CSSParser(f.read()).parse())
+    margin = browser.LAZY_LAYOUT_MARGIN_PX
+    viewport = (-margin, browser.HEIGHT - browser.CHROME_PX + margin)
+
+    for paragraphs in sizes:
+        nodes = browser.HTMLParser(text_page(paragraphs)).parse()
+        browser.style(nodes, rules, StyleTab(), force=True)
+        for lazy in [False, True]:
+            measure = browser.MeasureTime(
+                "first frame layout and paint ({} paragraphs, lazy={})".format(
+                    paragraphs, lazy))
+            for _ in range(rounds):
+                measure.start()
+                document = browser.DocumentLayout(nodes)
+                document.layout(1, viewport if lazy else None)
+                display_list = []
+                document.paint(display_list)
+                measure.stop()
+            print(measure.text())
+            print("Layout objects: {}".format(
+                len(browser.tree_to_list(document, []))))
+
+
+def bench_hit_test(paragraphs=500, clicks=100):
+    with open("browser.css") as f:
+        rules = browser.RuleIndex(browser.CSSParser(f.read()).parse())
+    nodes = browser.HTMLParser(text_page(paragraphs)).parse()
+    browser.style(nodes, rules, StyleTab(), force=True)
+    document = browser.DocumentLayout(nodes)
+    document.layout(1)
+    objs = browser.tree_to_list(document, [])
+    points = [(random.uniform(0, browser.WIDTH),
+               random.uniform(0, document.height)) for _ in range(clicks)]
+
+    measure = browser.MeasureTime(
+        "{} hit tests (linear scan)".format(clicks))
+    measure.start()
+    for x, y in points:
+        loc_rect = skia.Rect.MakeXYWH(x, y, 1, 1)
+        [obj for obj in objs
+         if browser.absolute_bounds_for_obj(obj).intersects(loc_rect)]
+    measure.stop()
+    print(measure.text())
+
+    measure = browser.MeasureTime(
+        "{} hit tests (index, including build)".format(clicks))
+    measure.start()
+    index = browser.HitTestIndex([
+        (browser.absolute_bounds_for_obj(obj), obj) for obj in objs])
+    for x, y in points:
+        index.hit_test(x, y)
+    measure.stop()
+    print(measure.text())
+
+
+def bench_traversal(paragraphs=20000, depth=16000, rounds=3):
+    nodes = browser.HTMLParser(synthetic_page(paragraphs)).parse()
+
+    def is_link(node):
+        return isinstance(node, browser.Element) and node.tag == "a"
+
+    def first_link_from_list():
+        return [node for node in browser.tree_to_list(nodes, [])
+                if is_link(node)][0]
+
+    def first_link_from_walk():
+        return browser.tree_find(nodes, is_link)
+
+    for name, find in [("list", first_link_from_list),
+                       ("walk", first_link_from_walk)]:
+        measure = browser.MeasureTime("find first link ({})".format(name))
+        for _ in range(rounds):
+            measure.start()
+            find()
+            measure.stop()
+        print(measure.text())
+        tracemalloc.start()
+        find()
+        print("Peak bytes: {}".format(tracemalloc.get_traced_memory()[1]))
+        tracemalloc.stop()
+
+    page = "<div>text " * depth + "</div>" * depth
+    nodes = browser.HTMLParser(page).parse()
+    count = sum(1 for node in browser.tree_walk(nodes))
+    print("Walked {} nodes at depth {}".format(count, depth))
+    # Style and accessibility keep their own stacks; layout and paint
+    # still recurse
+    with open("browser.css") as f:
+        rules = browser.RuleIndex(browser.CSSParser(f.read()).parse())
+    browser.style(nodes, rules, StyleTab(), force=True)
+    browser.AccessibilityNode(nodes).build()
+    print("Styled and built accessibility at depth {}".format(depth))
+
+
+def bench_culling(paragraphs=300, frames=10):
+    origin = start_server()
+    disable_http_cache()
+    add_pages({"/bench-culling": text_page(paragraphs)})
+    browser.LAZY_LAYOUT = False
+    browser.TILED_RASTER = False
+
+    b = make_browser()
+    tab = make_tab(b)
+    load_and_wait(b, tab, origin + "/bench-culling")
+    while not b.active_tab_display_list:
+        b.schedule_animation_frame()
+        time.sleep(0.001)
+
+    for cull in [False, True]:
+        browser.CULL_MARGIN_PX = browser.HEIGHT if cull else 10 ** 6
+        browser.CULL_STATS = browser.CullStats()
+        # Layer assignment is the same either way, so only raster and
+        # draw are timed
+        measure = browser.MeasureTime("raster and draw (cull={})".format(cull))
+        for i in range(frames):
+            b.scroll = i * 2 * browser.HEIGHT
+            b.composite()
+            browser.CULL_STATS.frames += 1
+            measure.start()
+            b.raster_tab()
+            b.paint_draw_list()
+            b.draw()
+            measure.stop()
+        print(measure.text())
+        print(browser.CULL_STATS.text())
+    tab.task_runner.set_needs_quit()
+
+
+def bench_tiled_raster(paragraphs=300, steps=60):
+    origin = start_server()
+    disable_http_cache()
+    add_pages({"/bench-tiled-raster": text_page(paragraphs)})
+    browser.LAZY_LAYOUT = False
+
+    b = make_browser()
+    tab = make_tab(b)
+    load_and_wait(b, tab, origin + "/bench-tiled-raster")
+    while not b.active_tab_display_list:
+        b.schedule_animation_frame()
+        time.sleep(0.001)
+
+    for tiled in [False, True]:
+        browser.TILED_RASTER = tiled
+        browser.TILE_CACHE = browser.TileCache(browser.TILE_CACHE_BYTES)
+        b.scroll = 0
+        b.composited_rect = None
+        b.composite()
+        b.needs_raster = True
+        # Layer assignment is timed by the composite benchmark; this is
+        # what a scroll step costs once the layers are known
+        measure = browser.MeasureTime(
+            "raster and draw per scroll step (tiled={})".format(tiled))
+        for _ in range(steps):
+            measure.start()
+            if b.needs_raster or tiled:
+                b.raster_tab()
+            b.paint_draw_list()
+            b.draw()
+            measure.stop()
+            b.needs_raster = False
+            b.handle_down()
+            if b.needs_composite:
+                b.composite()
+                b.needs_composite = False
+        print(measure.text())
+        if tiled:
+            print(browser.TILE_CACHE.text())
+        else:
+            print("Layer surface bytes: {}".format(sum(
+                layer.surface.width() * layer.surface.height() * 4
+                for layer in b.composited_layers if layer.surface)))
+    tab.task_runner.set_needs_quit()
+
+
+def layered_page(paragraphs, layers):
+    # Every so often a paragraph gets the composited layer an opacity
+    # animation would give it
+    page = "<!doctype html><html><body>"
+    for i in range(paragraphs):
+        p = "<p>Paragraph {} with <b>some</b> <i>text</i></p>".format(i)
+        if i % (paragraphs // layers) == 0:
+            p = "<div style=opacity:0.5>{}</div>".format(p)
+        page += p
+    return page + "</body></html>"
+
+
+def bench_composite(sizes=(500, 1000, 2000, 4000), layers=8, rounds=3):
+    with open("browser.css") as f:
+        rules = browser.RuleIndex(browser.CSSParser(f.read()).parse())
+    b = make_browser()
+    for paragraphs in sizes:
+        nodes = browser.HTMLParser(layered_page(paragraphs, layers)).parse()
+        browser.style(nodes, rules, StyleTab(), force=True)
+        document = browser.DocumentLayout(nodes)
+        document.layout(1)
+        display_list = []
+        document.paint(display_list)
+        items = sum(len(browser.tree_to_list(cmd, [])) for cmd in display_list)
+
+        measure = browser.MeasureTime(
+            "composite ({} display items)".format(items))
+        for _ in range(rounds):
+            b.active_tab_display_list = display_list
+            measure.start()
+            b.composite()
+            measure.stop()
+        print(measure.text())
+        print("Layers: {}".format(len(b.composited_layers)))
+
+
+def bench_damage(paragraphs=300, frames=30):
+    origin = start_server()
+    disable_http_cache()
+    add_pages({
+        "/bench-damage": text_page(paragraphs).replace(
+            "<body>", "<head><link rel=stylesheet href=/bench-damage.css>"
+            "</head><body><div>Fading</div>"),
+        "/bench-damage.css": "div { transition: opacity 1s; opacity: 0.9; }",
+    })
+    browser.LAZY_LAYOUT = False
+
+    b = make_browser()
+    tab = make_tab(b)
+    load_and_wait(b, tab, origin + "/bench-damage")
+    div = [node for node in browser.tree_to_list(tab.nodes, [])
+           if isinstance(node, browser.Element) and node.tag == "div"][0]
+
+    def fade(opacity):
+        div.attributes["style"] = "opacity:{}".format(opacity)
+        tab.set_needs_style(div)
+
+    def wait_for_commit():
+        while not b.needs_draw and not b.needs_composite:
+            b.set_needs_animation_frame(tab)
+            b.schedule_animation_frame()
+            time.sleep(0.001)
+
+    # Transitions start from the style of the first render
+    wait_for_commit()
+    b.composite_raster_and_draw()
+
+    for partial in [False, True]:
+        browser.PARTIAL_REDRAW = partial
+        b.lock.acquire(blocking=True)
+        b.scroll = 0
+        b.lock.release()
+
+        # Starting the transition paints and composites once; after
+        # that the tab only sends composited updates
+        run_on_tab(tab, fade, 0.1 if partial else 0.5)
+        wait_for_commit()
+        b.composite_raster_and_draw()
+        for name in ["opacity transition", "scrolling"]:
+            browser.DAMAGE_STATS = browser.DamageStats()
+            b.measure_composite_raster_and_draw = browser.MeasureTime(
+                "raster-and-draw, {} (partial={})".format(name, partial))
+            for _ in range(frames):
+                if name == "scrolling":
+                    b.handle_down()
+                else:
+                    wait_for_commit()
+                b.composite_raster_and_draw()
+            print(b.measure_composite_raster_and_draw.text())
+            print(browser.DAMAGE_STATS.text())
+    tab.task_runner.set_needs_quit()
+
+
+BENCHMARKS = {
+    "connection-pool": bench_connection_pool,
+    "subresources": bench_subresources,
+    "http-cache": bench_http_cache,
+    "streaming": bench_streaming,
+    "parse-throughput": bench_parse_throughput,
+    "deep-nesting": bench_deep_nesting,
+    "preload": bench_preload,
+    "memory": bench_memory,
+    "style-rules": bench_style_rules,
+    "descendant-selectors": bench_descendant_selectors,
+    "restyle": bench_restyle,
+    "style-sharing": bench_style_sharing,
+    "css-cache": bench_css_cache,
+    "layout-text": bench_layout_text,
+    "chrome-raster": bench_chrome_raster,
+    "relayout": bench_relayout,
+    "lazy-layout": bench_lazy_layout,
+    "hit-test": bench_hit_test,
+    "traversal": bench_traversal,
+    "culling": bench_culling,
+    "tiled-raster": bench_tiled_raster,
+    "composite": bench_composite,
+    "damage": bench_damage,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print("==", name)
+        BENCHMARKS[name]()
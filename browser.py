@@ -1,10 +1,23 @@
+import codecs
+import collections
+import concurrent.futures
 import ctypes
+import email.utils
+import getpass
+import hashlib
+import json
 import math
+import re
+import select
 import socket
 import ssl
+import sys
+import tempfile
 import threading
 import time
+import types
 import urllib.parse
+import zlib
 
 import dukpy
 import OpenGL.GL as GL
@@ -52,17 +65,14 @@ class URL:
                    ":" + str(self.port) + url)
 
     def request(self, top_level_url, payload=None):
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP
-        )
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
+        headers, chunks = self.request_stream(top_level_url, payload)
+        return headers, b"".join(chunks)
 
+    def request_stream(self, top_level_url, payload=None):
         method = "POST" if payload else "GET"
-        body = f'{method} {self.path} HTTP/1.0\r\nHost: {self.host}\r\n'
+        version = "HTTP/1.1" if HTTP_KEEP_ALIVE else "HTTP/1.0"
+        body = f'{method} {self.path} {version}\r\nHost: {self.host}\r\n'
+        body += "Accept-Encoding: gzip, deflate\r\n"
         if payload:
             length = len(payload.encode("utf8"))
             body += f"Content-Length: {length}\r\n"
@@ -71,34 +81,46 @@ class URL:
             allow_cookie = True
 
             if top_level_url and params.get("samesite", "none") == "lax":
-                _, _, top_level_host, _ = top_level_url.split("/", 3)
-                top_level_host, _ = top_level_host.split(":", 1)
+                _, _, top_level_host, _ = str(top_level_url).split("/", 3)
+                top_level_host = top_level_host.split(":", 1)[0]
                 allow_cookie = (self.host == top_level_host or method == "GET")
             if allow_cookie:
                 body += f'Cookie: {cookie}\r\n'
 
-        body += "\r\n" + (payload or "")
-
-        s.connect((self.host, self.port))
-        s.send(body.encode())
+        entry = None
+        if method == "GET":
+            entry = HTTP_CACHE.get(str(self))
+            if entry and entry.is_fresh(time.time()):
+                HTTP_CACHE.count_hit(entry)
+                return entry.headers, [entry.body]
+            if entry:
+                for header, value in entry.validators().items():
+                    body += f"{header}: {value}\r\n"
 
-        response = s.makefile("b")
-
-        statusline = response.readline().decode('utf8')
-
-        version, status, explanation = statusline.split(" ", 2)
-        assert status == "200", f"{status}: {explanation}"
+        body += "\r\n" + (payload or "")
 
-        headers = {}
-        while True:
-            line = response.readline().decode('utf8')
-            if line == "\r\n":
-                break
-            header, value = line.split(":", 1)
-            headers[header.lower()] = value.strip()
+        # An idle connection may turn out to be closed only once the
+        # request is sent, and only a GET is safe to send again; a POST
+        # the server already handled would be submitted twice
+        if HTTP_KEEP_ALIVE and method == "GET":
+            conn, reused = CONNECTION_POOL.acquire(
+                self.scheme, self.host, self.port)
+            try:
+                status, explanation, headers = conn.send_head(body)
+            except OSError:
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped an idle connection; retry on a new one
+                conn = Connection(self.scheme, self.host, self.port)
+                status, explanation, headers = conn.send_head(body)
+        else:
+            conn = Connection(self.scheme, self.host, self.port)
+            status, explanation, headers = conn.send_head(body)
 
-        assert "transfer-encoding" not in headers
-        assert "content-encoding" not in headers
+        if not (status == "200" or (status == "304" and entry)):
+            conn.close()
+            raise AssertionError(f"{status}: {explanation}")
 
         if 'set-cookie' in headers:
             params = {}
@@ -112,10 +134,42 @@ class URL:
                         params[param_pair.strip().lower()] = True
             COOKIE_JAR[self.host] = (cookie, params)
 
-        body = response.read()
-        s.close()
+        if status == "304":
+            for _ in conn.body_chunks(status, headers):
+                pass
+            self.release(conn)
+            entry = HTTP_CACHE.revalidated(str(self), entry, headers)
+            return entry.headers, [entry.body]
+
+        if method == "GET":
+            HTTP_CACHE.count_miss()
+        return headers, self.stream_body(conn, method, status, headers)
 
-        return headers, body
+    def stream_body(self, conn, method, status, headers):
+        cacheable = method == "GET" and is_cacheable(headers)
+        parts = []
+        try:
+            for data in conn.body_chunks(status, headers):
+                if cacheable:
+                    parts.append(data)
+                yield data
+        except BaseException:
+            # The rest of the response is still on the way, so the
+            # connection can't be reused
+            conn.close()
+            raise
+        self.release(conn)
+
+        if cacheable:
+            HTTP_CACHE.put(str(self), headers, b"".join(parts))
+        else:
+            HTTP_CACHE.invalidate(str(self))
+
+    def release(self, conn):
+        if HTTP_KEEP_ALIVE:
+            CONNECTION_POOL.release(conn)
+        else:
+            conn.close()
 
     def __str__(self):
         port_part = ":" + str(self.port)
@@ -126,13 +180,514 @@ class URL:
         return self.scheme + "://" + self.host + port_part + self.path
 
 
+HTTP_KEEP_ALIVE = True
+MAX_IDLE_CONNECTIONS_PER_HOST = 6
+MAX_IDLE_CONNECTIONS = 32
+IDLE_CONNECTION_TIMEOUT_SEC = 30
+
+
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class ContentDecoder:
+    def __init__(self, encoding):
+        self.encoding = encoding.strip().lower()
+        if self.encoding in ["gzip", "x-gzip"]:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.decompressor = zlib.decompressobj()
+            self.started = False
+        else:
+            assert self.encoding == "identity", \
+                f"Unsupported content-encoding {self.encoding}"
+            self.decompressor = None
+
+    def decode(self, data):
+        if not self.decompressor:
+            return data
+        if self.encoding == "deflate" and not self.started:
+            self.started = True
+            try:
+                return self.decompressor.decompress(data)
+            except zlib.error:
+                # Some servers send a raw deflate stream without the
+                # zlib header
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        if not self.decompressor:
+            return b""
+        return self.decompressor.flush()
+
+
+class Connection:
+    def __init__(self, scheme, host, port):
+        self.key = (scheme, host, port)
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP
+        )
+        if scheme == "https":
+            ctx = ssl.create_default_context()
+            s = ctx.wrap_socket(s, server_hostname=host)
+        s.connect((host, port))
+
+        self.socket = s
+        self.response = s.makefile("b")
+        self.keep_alive = False
+        self.last_used = time.time()
+
+    def send_head(self, request):
+        self.socket.sendall(request.encode())
+
+        statusline = self.response.readline().decode('utf8')
+        if not statusline:
+            raise ConnectionError("Connection closed by server")
+        version, status, explanation = statusline.split(" ", 2)
+
+        headers = {}
+        while True:
+            line = self.response.readline().decode('utf8')
+            if line == "\r\n" or not line:
+                break
+            header, value = line.split(":", 1)
+            headers[header.lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            self.keep_alive = connection != "close"
+        else:
+            self.keep_alive = connection == "keep-alive"
+
+        # The body handed to callers is always decoded, so the headers
+        # should describe it that way too
+        self.transfer_encoding = headers.pop("transfer-encoding", "identity")
+        self.decoder = ContentDecoder(headers.pop("content-encoding", "identity"))
+        self.content_length = headers.get("content-length")
+        if self.transfer_encoding.lower() != "identity" or \
+                self.decoder.decompressor:
+            headers.pop("content-length", None)
+        return status, explanation, headers
+
+    def body_chunks(self, status, headers):
+        if status in ["204", "304"]:
+            raw_chunks = []
+        elif self.transfer_encoding.lower() == "chunked":
+            raw_chunks = self.read_chunked()
+        elif self.transfer_encoding.lower() == "identity" and \
+                self.content_length is not None:
+            raw_chunks = self.read_length(int(self.content_length))
+        else:
+            raw_chunks = self.read_until_close()
+
+        for data in raw_chunks:
+            data = self.decoder.decode(data)
+            if data:
+                yield data
+        data = self.decoder.flush()
+        if data:
+            yield data
+        self.last_used = time.time()
+
+    def read_length(self, remaining):
+        while remaining > 0:
+            data = self.response.read1(min(remaining, READ_CHUNK_BYTES))
+            if not data:
+                raise ConnectionError("Connection closed mid-body")
+            remaining -= len(data)
+            yield data
+
+    def read_chunked(self):
+        while True:
+            line = self.response.readline()
+            if not line:
+                raise ConnectionError("Connection closed mid-body")
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                break
+            yield from self.read_length(size)
+            self.response.readline()
+
+        # Skip any trailer headers
+        while True:
+            line = self.response.readline()
+            if line in [b"\r\n", b"\n", b""]:
+                break
+
+    def read_until_close(self):
+        self.keep_alive = False
+        while True:
+            data = self.response.read1(READ_CHUNK_BYTES)
+            if not data:
+                break
+            yield data
+
+    def is_stale(self, now):
+        if now - self.last_used > IDLE_CONNECTION_TIMEOUT_SEC:
+            return True
+        # An idle socket only becomes readable when the server closed it
+        readable, _, _ = select.select([self.socket], [], [], 0)
+        return bool(readable)
+
+    def close(self):
+        self.response.close()
+        self.socket.close()
+
+
+class ConnectionPool:
+    def __init__(self):
+        self.idle = {}
+        self.num_idle = 0
+        self.lock = threading.Lock()
+
+        self.num_connects = 0
+        self.num_reuses = 0
+
+    def acquire(self, scheme, host, port):
+        key = (scheme, host, port)
+        conn = None
+        self.lock.acquire(blocking=True)
+        self.evict_stale()
+        if self.idle.get(key):
+            conn = self.idle[key].pop()
+            self.num_idle -= 1
+            self.num_reuses += 1
+        else:
+            self.num_connects += 1
+        self.lock.release()
+
+        if conn:
+            return conn, True
+        return Connection(scheme, host, port), False
+
+    def release(self, conn):
+        if not conn.keep_alive:
+            conn.close()
+            return
+
+        self.lock.acquire(blocking=True)
+        conns = self.idle.setdefault(conn.key, [])
+        conns.append(conn)
+        self.num_idle += 1
+        if len(conns) > MAX_IDLE_CONNECTIONS_PER_HOST:
+            self.remove(conns[0])
+        while self.num_idle > MAX_IDLE_CONNECTIONS:
+            oldest = min([conns[0] for conns in self.idle.values() if conns],
+                         key=lambda conn: conn.last_used)
+            self.remove(oldest)
+        self.lock.release()
+
+    def evict_stale(self):
+        now = time.time()
+        for conns in self.idle.values():
+            for conn in [conn for conn in conns if conn.is_stale(now)]:
+                self.remove(conn)
+
+    def remove(self, conn):
+        self.idle[conn.key].remove(conn)
+        self.num_idle -= 1
+        conn.close()
+
+    def close_all(self):
+        self.lock.acquire(blocking=True)
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle = {}
+        self.num_idle = 0
+        self.lock.release()
+
+    def text(self):
+        return "Connections opened: {}, reused: {}".format(
+            self.num_connects, self.num_reuses)
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+CACHE_MEMORY_BYTES = 16 * 1024 * 1024
+CACHE_DISK_BYTES = 128 * 1024 * 1024
+CACHE_DIR = os.path.join(
+    tempfile.gettempdir(), "elli-browser-cache-" + getpass.getuser())
+CACHE_INDEX_WRITE_SEC = 5
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().lower()
+        if not directive:
+            continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = True
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def is_cacheable(headers):
+    cache_control = parse_cache_control(headers.get("cache-control", ""))
+    if "no-store" in cache_control:
+        return False
+    if headers.get("vary", "").strip() == "*":
+        return False
+    if "set-cookie" in headers:
+        return False
+    return "max-age" in cache_control or "expires" in headers \
+        or "etag" in headers or "last-modified" in headers
+
+
+class CacheEntry:
+    def __init__(self, headers, body, stored_at):
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.size = len(body)
+
+    def lifetime(self):
+        cache_control = parse_cache_control(
+            self.headers.get("cache-control", ""))
+        if "no-cache" in cache_control:
+            return 0
+        if "max-age" in cache_control:
+            try:
+                return int(cache_control["max-age"])
+            except ValueError:
+                return 0
+        if "expires" in self.headers:
+            expires = parse_http_date(self.headers["expires"])
+            date = parse_http_date(self.headers.get("date", ""))
+            if expires:
+                return expires - (date or self.stored_at)
+        return 0
+
+    def age(self, now):
+        try:
+            age = int(self.headers.get("age", "0"))
+        except ValueError:
+            age = 0
+        return age + now - self.stored_at
+
+    def is_fresh(self, now):
+        return self.age(now) < self.lifetime()
+
+    def validators(self):
+        headers = {}
+        if "etag" in self.headers:
+            headers["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+        return headers
+
+
+class HTTPCache:
+    def __init__(self, memory_bytes, disk_bytes, directory):
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.max_memory_bytes = memory_bytes
+
+        self.directory = directory
+        self.index = None
+        self.index_dirty = False
+        self.index_written_at = 0
+        self.disk_bytes = 0
+        self.max_disk_bytes = disk_bytes
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.disk_reads = 0
+        self.bytes_saved = 0
+
+    def get(self, key):
+        self.lock.acquire(blocking=True)
+        entry = self.memory.get(key)
+        if entry:
+            self.memory.move_to_end(key)
+        else:
+            entry = self.read_disk(key)
+            if entry:
+                self.disk_reads += 1
+                self.store_memory(key, entry)
+        self.lock.release()
+        return entry
+
+    def put(self, key, headers, body):
+        if not is_cacheable(headers):
+            self.invalidate(key)
+            return
+        entry = CacheEntry(headers, body, time.time())
+        self.lock.acquire(blocking=True)
+        self.store_memory(key, entry)
+        self.write_disk(key, entry)
+        self.lock.release()
+
+    def revalidated(self, key, entry, headers):
+        merged = dict(entry.headers)
+        for header, value in headers.items():
+            if header not in ["content-length", "set-cookie"]:
+                merged[header] = value
+        new_entry = CacheEntry(merged, entry.body, time.time())
+        self.lock.acquire(blocking=True)
+        self.revalidations += 1
+        self.bytes_saved += entry.size
+        self.store_memory(key, new_entry)
+        self.write_disk(key, new_entry)
+        self.lock.release()
+        return new_entry
+
+    def invalidate(self, key):
+        self.lock.acquire(blocking=True)
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).size
+        self.load_index()
+        if self.index is not None and key in self.index:
+            self.remove_disk(key)
+            self.index_changed()
+        self.lock.release()
+
+    def flush(self):
+        self.lock.acquire(blocking=True)
+        if self.index_dirty:
+            self.write_index()
+        self.lock.release()
+
+    def count_hit(self, entry):
+        self.lock.acquire(blocking=True)
+        self.hits += 1
+        self.bytes_saved += entry.size
+        self.lock.release()
+
+    def count_miss(self):
+        self.lock.acquire(blocking=True)
+        self.misses += 1
+        self.lock.release()
+
+    def store_memory(self, key, entry):
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).size
+        if entry.size > self.max_memory_bytes:
+            return
+        self.memory[key] = entry
+        self.memory_bytes += entry.size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.size
+
+    def load_index(self):
+        if self.index is not None or not self.directory:
+            return
+        # Cached responses are private to the user, so the directory
+        # has to be too
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if hasattr(os, "getuid") and \
+                    os.stat(self.directory).st_uid != os.getuid():
+                raise PermissionError(self.directory)
+            os.chmod(self.directory, 0o700)
+        except OSError as e:
+            print("Disk cache disabled: " + str(e))
+            self.directory = None
+            return
+        try:
+            with open(os.path.join(self.directory, "index.json")) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.disk_bytes = sum([record["size"]
+                               for record in self.index.values()])
+
+    def index_changed(self):
+        # Writing the index is linear in its size, so writes are batched
+        self.index_dirty = True
+        if time.time() - self.index_written_at >= CACHE_INDEX_WRITE_SEC:
+            self.write_index()
+
+    def write_index(self):
+        path = os.path.join(self.directory, "index.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
+        self.index_dirty = False
+        self.index_written_at = time.time()
+
+    def read_disk(self, key):
+        self.load_index()
+        if not self.index or key not in self.index:
+            return None
+        record = self.index[key]
+        try:
+            with open(os.path.join(self.directory, record["file"]), "rb") as f:
+                body = f.read()
+        except OSError:
+            self.remove_disk(key)
+            return None
+        record["last_used"] = time.time()
+        return CacheEntry(record["headers"], body, record["stored_at"])
+
+    def write_disk(self, key, entry):
+        self.load_index()
+        if self.index is None or entry.size > self.max_disk_bytes:
+            return
+        if key in self.index:
+            self.remove_disk(key)
+        filename = hashlib.sha1(key.encode("utf8")).hexdigest()
+        with open(os.path.join(self.directory, filename), "wb") as f:
+            f.write(entry.body)
+        self.index[key] = {
+            "file": filename,
+            "headers": entry.headers,
+            "stored_at": entry.stored_at,
+            "last_used": time.time(),
+            "size": entry.size,
+        }
+        self.disk_bytes += entry.size
+        while self.disk_bytes > self.max_disk_bytes:
+            oldest = min(self.index,
+                         key=lambda key: self.index[key]["last_used"])
+            self.remove_disk(oldest)
+        self.index_changed()
+
+    def remove_disk(self, key):
+        record = self.index.pop(key)
+        self.disk_bytes -= record["size"]
+        try:
+            os.remove(os.path.join(self.directory, record["file"]))
+        except OSError:
+            pass
+
+    def text(self):
+        return ("Cache hits: {}, misses: {}, revalidations: {}, " +
+                "disk reads: {}, bytes saved: {}").format(
+            self.hits, self.misses, self.revalidations,
+            self.disk_reads, self.bytes_saved)
+
+
+HTTP_CACHE = HTTPCache(CACHE_MEMORY_BYTES, CACHE_DISK_BYTES, CACHE_DIR)
+
+
 WIDTH, HEIGHT = 800, 600
 HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 FONTS = {}
+MAX_FONTS = 1024
+SKIA_FONTS = {}
+FONT_METRICS = {}
 
 
-def get_font(size, weight, style):
+def get_typeface(weight, style):
     key = (weight, style)
     if key not in FONTS:
         skia_weight = skia.FontStyle.kBold_Weight if weight == "bold" \
@@ -144,7 +699,31 @@ def get_font(size, weight, style):
 
         font = skia.Typeface('Arial', style_info)
         FONTS[key] = font
-    return skia.Font(FONTS[key], size)
+    return FONTS[key]
+
+
+def get_font(size, weight, style):
+    key = (size, weight, style)
+    font = SKIA_FONTS.get(key)
+    if font is None:
+        font = skia.Font(get_typeface(weight, style), size)
+        if len(SKIA_FONTS) >= MAX_FONTS:
+            SKIA_FONTS.clear()
+        SKIA_FONTS[key] = font
+    return font
+
+
+def get_metrics(font):
+    # skia.Font isn't hashable, so key by id and keep the font alive in
+    # the entry so the id can't be reused by another font
+    entry = FONT_METRICS.get(id(font))
+    if entry is None:
+        metrics = font.getMetrics()
+        entry = (font, metrics.fAscent, metrics.fDescent)
+        if len(FONT_METRICS) >= MAX_FONTS:
+            FONT_METRICS.clear()
+        FONT_METRICS[id(font)] = entry
+    return entry[1], entry[2]
 
 
 def parse_color(color):
@@ -179,7 +758,7 @@ def draw_text(canvas, x, y, text, font, color):
     sk_color = parse_color(color)
     paint = skia.Paint(AntiAlias=True, Color=sk_color)
     canvas.drawString(
-        text, float(x), y - font.getMetrics().fAscent,
+        text, float(x), y - get_metrics(font)[0],
         font, paint
     )
 
@@ -200,7 +779,7 @@ def draw_rect(canvas, l, t, r, b, fill_color=None, border_color="black", width=1
 def paint_visual_effects(node, cmds, rect):
     blend_mode = parse_blend_mode(node.style.get("mix-blend-mode"))
     opacity = float(node.style.get("opacity", 1.0))
-    border_radius = float(node.style.get("border-radius", "0px")[:-2])
+    border_radius = css_length(node.style.get("border-radius", "0px"))[0]
     translation = parse_transform(node.style.get("transform", ""))
 
     needs_clip = node.style.get("overflow", "visible") == "clip"
@@ -232,8 +811,8 @@ def parse_blend_mode(blend_mode_str):
 
 
 def linespace(font):
-    metrics = font.getMetrics()
-    return metrics.fDescent - metrics.fAscent
+    ascent, descent = get_metrics(font)
+    return descent - ascent
 
 
 class MeasureTime:
@@ -259,28 +838,43 @@ class MeasureTime:
 
 
 class Text:
+    __slots__ = ["text", "children", "parent", "style", "animations",
+                 "layout_object", "save_layer", "style_dirty",
+                 "children_dirty"]
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        # Text nodes never get children, so they can share an empty tuple
+        self.children = ()
         self.parent = parent
         self.style = {}
-        self.animations = {}
+        self.style_dirty = True
+        self.children_dirty = True
+        self.animations = None
         self.layout_object = None
+        self.save_layer = None
 
     def __repr__(self):
         return repr(self.text)
 
 
 class Element:
+    __slots__ = ["tag", "attributes", "children", "parent", "style",
+                 "style_dirty", "children_dirty", "animations", "is_focused",
+                 "layout_object", "save_layer", "image", "encoded_data"]
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
         self.children = []
         self.parent = parent
         self.style = {}
-        self.animations = {}
+        self.style_dirty = True
+        self.children_dirty = True
+        self.animations = None
         self.is_focused = False
         self.layout_object = None
+        self.save_layer = None
 
     def __repr__(self):
         return repr("<" + self.tag + ">")
@@ -292,34 +886,74 @@ def print_tree(node, indent=0):
         print_tree(child, indent + 2)
 
 
+MAX_ENTITY_CHARS = 32
+
+
+class BodyDecoder:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf8")()
+        self.pending = ""
+
+    def decode(self, data, final=False):
+        text = self.pending + self.decoder.decode(data, final)
+        self.pending = ""
+        # Hold back a character reference that may continue in the next
+        # chunk, so that html.unescape sees it whole
+        amp = text.rfind("&")
+        if not final and amp >= 0 and len(text) - amp <= MAX_ENTITY_CHARS \
+                and ";" not in text[amp:]:
+            text, self.pending = text[:amp], text[amp:]
+        return html.unescape(text)
+
+
 class HTMLParser:
-    def __init__(self, body):
+    def __init__(self, body="", on_node=None):
         self.body = body
         self.unfinished = []
+        self.on_node = on_node
 
-    def parse(self):
-        text = ""
-        in_tag = False
+        self.text = ""
+        self.in_tag = False
 
-        for c in self.body:
-            if c == "<":
-                in_tag = True
+    def parse(self):
+        self.feed(self.body)
+        return self.close()
+
+    TAG_DELIMITER = re.compile("[<>]")
+
+    def feed(self, chunk):
+        text = self.text
+        start = 0
+        for match in self.TAG_DELIMITER.finditer(chunk):
+            end = match.start()
+            text = text + chunk[start:end] if text else chunk[start:end]
+            if chunk[end] == "<":
+                self.in_tag = True
                 if text:
                     self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
             else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
+                self.in_tag = False
+                self.add_tag(text)
+            text = ""
+            start = end + 1
+        self.text = text + chunk[start:]
+
+    def close(self):
+        if not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
         return self.finish()
 
+    def root(self):
+        if self.unfinished:
+            return self.unfinished[0]
+        return None
+
     def get_attributes(self, text: str):
-        parts = [part.strip() for part in text.split()]
-        tag = parts[0].lower()
+        parts = text.split()
+        tag = sys.intern(parts[0].lower())
+        if len(parts) == 1:
+            return tag, {}
 
         attributes = {}
         for attrpair in parts[1:]:
@@ -327,9 +961,9 @@ class HTMLParser:
                 key, value = attrpair.split("=", 1)
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1: -1]
-                attributes[key.lower()] = value
+                attributes[sys.intern(key.lower())] = value
             else:
-                attributes[attrpair.lower()] = ''
+                attributes[sys.intern(attrpair.lower())] = ''
         return tag, attributes
 
     def add_text(self, text):
@@ -339,11 +973,13 @@ class HTMLParser:
         parent = self.unfinished[-1]
         node = Text(text, parent)
         parent.children.append(node)
+        if self.on_node:
+            self.on_node(node)
 
-    SELF_CLOSING_TAGS = [
+    SELF_CLOSING_TAGS = {
         "area", "base", "br", "col", "embed", "hr", "img", "input",
         "link", "meta", "param", "source", "track", "wbr",
-    ]
+    }
 
     def add_tag(self, tag):
         tag, attributes = self.get_attributes(tag)
@@ -357,30 +993,36 @@ class HTMLParser:
         elif tag.startswith('/'):
             if len(self.unfinished) == 1:
                 return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
+            return
         else:
+            # Attach elements as soon as they open, so that a partially
+            # parsed document is already a connected tree
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
+            if parent:
+                parent.children.append(node)
             self.unfinished.append(node)
+        if self.on_node:
+            self.on_node(node)
 
-    HEAD_TAGS = [
+    HEAD_TAGS = {
         "base", "basefont", "bgsound", "noscript",
         "link", "meta", "title", "style", "script",
-    ]
+    }
 
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            depth = len(self.unfinished)
+            if depth == 0 and tag != "html":
                 self.add_tag("html")
-            elif open_tags == "html" and tag not in ["head", "body", "/html"]:
+            elif depth == 1 and tag not in ("head", "body", "/html"):
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and tag not in ["/head"] + self.HEAD_TAGS:
+            elif depth == 2 and self.unfinished[1].tag == "head" and \
+                    tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
@@ -389,12 +1031,47 @@ class HTMLParser:
         if len(self.unfinished) == 0:
             self.add_tag("html")
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
         return self.unfinished.pop()
 
 
+MAX_PRELOAD_TAG_BYTES = 4096
+
+
+class PreloadScanner:
+    PRELOAD_TAG = re.compile(rb"<((?:link|script|img)\s[^<>]*)>", re.I)
+
+    def __init__(self, on_preload):
+        self.on_preload = on_preload
+        self.parser = HTMLParser()
+        self.tail = b""
+
+    def scan(self, data):
+        data = self.tail + data
+        for match in self.PRELOAD_TAG.finditer(data):
+            self.scan_tag(match.group(1))
+
+        # Keep an unterminated tag around for the next chunk
+        start = data.rfind(b"<")
+        if start > data.rfind(b">") and \
+                len(data) - start <= MAX_PRELOAD_TAG_BYTES:
+            self.tail = data[start:]
+        else:
+            self.tail = b""
+
+    def scan_tag(self, data):
+        text = html.unescape(data.decode("utf8", errors="replace"))
+        tag, attributes = self.parser.get_attributes(text)
+        if tag == "link" and attributes.get("rel") == "stylesheet":
+            src = attributes.get("href")
+        elif tag in ["script", "img"]:
+            src = attributes.get("src")
+        else:
+            return
+        if src:
+            self.on_preload(src)
+
+
 BLOCK_ELEMENTS = [
     "html", "body", "article", "section", "nav", "aside",
     "h1", "h2", "h3", "h4", "h5", "h6", "hgroup", "header",
@@ -423,6 +1100,8 @@ class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.rightmost_tag = tag
+        self.ancestor_tags = []
 
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
@@ -433,6 +1112,9 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        self.rightmost_tag = descendant.rightmost_tag
+        self.ancestor_tags = ancestor.ancestor_tags + \
+            [ancestor.rightmost_tag] + descendant.ancestor_tags
 
     def matches(self, node):
         if not self.descendant.matches(node):
@@ -451,6 +1133,8 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
+LAYOUT_PROPERTIES = ["font-size", "font-style", "font-weight"]
+
 
 class NumericAnimation:
     def __init__(self, old_value, new_value, num_frames):
@@ -499,67 +1183,187 @@ ANIMATED_PROPERTIES = {
 }
 
 
+MAX_CSS_LENGTHS = 4096
+CSS_LENGTHS = {}
+CSS_LENGTH_UNITS = ["px", "rem", "%"]
+
+
+def css_length(value):
+    # The same few length strings come up on every node, so parse each
+    # one once; returns (number, unit)
+    length = CSS_LENGTHS.get(value)
+    if length is None:
+        for unit in CSS_LENGTH_UNITS:
+            if value.endswith(unit):
+                length = (float(value[:-len(unit)]), unit)
+                break
+        else:
+            length = (float(value[:-2]), value[-2:])
+        if len(CSS_LENGTHS) >= MAX_CSS_LENGTHS:
+            CSS_LENGTHS.clear()
+        CSS_LENGTHS[value] = length
+    return length
+
+
 def get_root_node(node):
-    if node.parent:
-        return get_root_node(node.parent)
-    else:
-        return node
+    while node.parent:
+        node = node.parent
+    return node
+
+
+def style(node, rules, tab, ancestors=None, force=False):
+    if ancestors is None:
+        ancestors = AncestorFilter()
+        parent_chain = []
+        parent = node.parent
+        while parent:
+            parent_chain.append(parent)
+            parent = parent.parent
+        for parent in reversed(parent_chain):
+            ancestors.push(parent)
+        rules.shared_styles.clear()
+
+    # Deep documents would run out of Python stack, so children go on
+    # an explicit one; a None in place of force marks leaving a node
+    stack = [(node, force)]
+    while stack:
+        node, force = stack.pop()
+        if force is None:
+            ancestors.pop(node)
+            node.children_dirty = False
+            continue
+
+        if force or node.style_dirty:
+            old_style = node.style
+            node.style = rules.computed_style(node, tab, ancestors)
+            if old_style:
+                start_transitions(node, old_style, tab)
+            if not old_style or layout_style_changed(old_style, node.style):
+                mark_layout_dirty(node)
+            if not force and old_style:
+                if not node.parent and \
+                        old_style["font-size"] != node.style["font-size"]:
+                    # rem sizes anywhere in the document depend on the root
+                    force = True
+                elif inherited_style_changed(old_style, node.style):
+                    for child in node.children:
+                        child.style_dirty = True
+                    node.children_dirty = True
+        node.style_dirty = False
+
+        if node.children and (force or node.children_dirty):
+            ancestors.push(node)
+            stack.append((node, None))
+            for child in reversed(node.children):
+                stack.append((child, force))
+        else:
+            node.children_dirty = False
+
+
+def mark_style_dirty(node):
+    node.style_dirty = True
+    parent = node.parent
+    while parent and not parent.children_dirty:
+        parent.children_dirty = True
+        parent = parent.parent
+
+
+def inherited_style_changed(old_style, new_style):
+    for prop in INHERITED_PROPERTIES:
+        if old_style.get(prop) != new_style[prop]:
+            return True
+    return False
+
+
+def layout_style_changed(old_style, new_style):
+    if old_style is new_style:
+        return False
+    for prop in LAYOUT_PROPERTIES:
+        if old_style[prop] != new_style[prop]:
+            return True
+    return False
 
 
-def style(node, rules, tab):
-    old_style = node.style
+MAX_INLINE_STYLES = 1024
+INLINE_STYLES = collections.OrderedDict()
 
-    node.style = {}
+
+def parse_inline_style(s):
+    if s in INLINE_STYLES:
+        INLINE_STYLES.move_to_end(s)
+        return INLINE_STYLES[s]
+    pairs = CSSParser(s).body()
+    INLINE_STYLES[s] = pairs
+    if len(INLINE_STYLES) > MAX_INLINE_STYLES:
+        INLINE_STYLES.popitem(last=False)
+    return pairs
+
+
+def compute_style(node, rules, tab, ancestors):
+    style = {}
 
     # Inherited styles (browser defaults)
     for prop, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
-            node.style[prop] = node.parent.style[prop]
+            style[prop] = node.parent.style[prop]
         else:
-            node.style[prop] = default_value
+            style[prop] = default_value
 
     # Selector styles (eg. .css files)
-    for media, selector, body in rules:
+    for media, selector, body in rules.candidates(node):
         if media:
             if (media == "dark") != tab.dark_mode:
                 continue
+        if not ancestors.may_match(selector):
+            continue
         if not selector.matches(node):
             continue
         for prop, value in body.items():
-            node.style[prop] = value
+            style[prop] = value
 
     # Inline styles (element style attributes)
     if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+        pairs = parse_inline_style(node.attributes["style"])
         for prop, value in pairs.items():
-            node.style[prop] = value
+            style[prop] = value
 
-    if node.style["font-size"].endswith("%"):
+    font_size, unit = css_length(style["font-size"])
+    if unit == "%":
         if node.parent:
             parent_font_size = node.parent.style["font-size"]
         else:
             parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
-    elif node.style["font-size"].endswith("rem"):
+        node_pct = font_size / 100
+        parent_px = css_length(parent_font_size)[0]
+        style["font-size"] = str(node_pct * parent_px) + "px"
+    elif unit == "rem":
         root_node = get_root_node(node)
-        root_px = float(root_node.style["font-size"][:-2])
-        node_rem = float(node.style["font-size"][:-3])
-        node.style["font-size"] = str(root_px * node_rem) + "px"
-
-    if old_style:
-        transitions = diff_styles(old_style, node.style)
-        for property, (old_value, new_value, num_frames) in transitions.items():
-            if property in ANIMATED_PROPERTIES:
-                tab.set_needs_render()
-                AnimationClass = ANIMATED_PROPERTIES[property]
-                animation = AnimationClass(old_value, new_value, num_frames)
-                node.animations[property] = animation
-                node.style[property] = animation.animate()
+        root_style = root_node.style if root_node is not node else style
+        root_px = css_length(root_style["font-size"])[0]
+        style["font-size"] = str(root_px * font_size) + "px"
 
-    for child in node.children:
-        style(child, rules, tab)
+    return style
+
+
+def start_transitions(node, old_style, tab):
+    transitions = diff_styles(old_style, node.style)
+    for property, (old_value, new_value, num_frames) in transitions.items():
+        if property in ANIMATED_PROPERTIES:
+            tab.set_needs_render()
+            AnimationClass = ANIMATED_PROPERTIES[property]
+            animation = AnimationClass(old_value, new_value, num_frames)
+            if node.animations is None:
+                node.animations = {}
+            node.animations[property] = animation
+            set_animated_style(node, property, animation.animate())
+
+
+def set_animated_style(node, property, value):
+    # Computed styles are shared between nodes, so animated values go
+    # into a private copy
+    style = dict(node.style)
+    style[property] = value
+    node.style = style
 
 
 def parse_transition(value):
@@ -609,6 +1413,133 @@ def cascade_priority(rule):
     return selector.priority
 
 
+ANCESTOR_FILTER_BITS = 12
+
+
+class AncestorFilter:
+    # Counting bloom filter over the tags of the elements currently
+    # being styled above a node; descendant selectors naming a tag it
+    # has never seen cannot match. It also numbers each distinct chain
+    # of (tag, focus) ancestors, which is all that selectors can see.
+    def __init__(self):
+        self.mask = (1 << ANCESTOR_FILTER_BITS) - 1
+        self.counts = [0] * (1 << ANCESTOR_FILTER_BITS)
+        self.paths = {}
+        self.path_ids = [0]
+
+    def slots(self, tag):
+        h = hash(tag)
+        return h & self.mask, (h >> ANCESTOR_FILTER_BITS) & self.mask
+
+    def push(self, node):
+        for slot in self.slots(node.tag):
+            self.counts[slot] += 1
+        path = (self.path_ids[-1], node.tag, node.is_focused)
+        self.path_ids.append(self.paths.setdefault(path, len(self.paths) + 1))
+
+    def pop(self, node):
+        for slot in self.slots(node.tag):
+            self.counts[slot] -= 1
+        self.path_ids.pop()
+
+    def path_id(self):
+        return self.path_ids[-1]
+
+    def may_contain(self, tag):
+        first, second = self.slots(tag)
+        return self.counts[first] > 0 and self.counts[second] > 0
+
+    def may_match(self, selector):
+        for tag in selector.ancestor_tags:
+            if not self.may_contain(tag):
+                return False
+        return True
+
+
+MAX_COMPUTED_STYLES = 4096
+
+
+class RuleIndex:
+    def __init__(self, rules):
+        # Every selector ends in a tag selector, so each rule can only
+        # match elements with that tag; buckets keep cascade order
+        self.rules_by_tag = {}
+        for rule in sorted(rules, key=cascade_priority):
+            media, selector, body = rule
+            self.rules_by_tag.setdefault(
+                selector.rightmost_tag, []).append(rule)
+            if "font-size" in body:
+                try:
+                    css_length(body["font-size"])
+                except ValueError:
+                    pass
+
+        self.computed_styles = {}
+        self.style_sizes = {}
+        self.shared_styles = {}
+        self.num_styled = 0
+        self.num_shared = 0
+        self.bytes_saved = 0
+
+    def candidates(self, node):
+        if isinstance(node, Element):
+            return self.rules_by_tag.get(node.tag, [])
+        return []
+
+    def sharing_key(self, node, ancestors):
+        # Selectors only look at tags and focus, so a node styles like an
+        # earlier one with the same tag and focus, the same parent style
+        # and the same chain of ancestors. The key holds on to the parent
+        # style so that its id stays unique.
+        parent_style = node.parent.style if node.parent else None
+        if isinstance(node, Text):
+            return (id(parent_style),), parent_style
+        if "style" in node.attributes:
+            return None, None
+        key = (node.tag, node.is_focused, id(parent_style),
+               ancestors.path_id())
+        return key, parent_style
+
+    def computed_style(self, node, tab, ancestors):
+        self.num_styled += 1
+        key, parent_style = self.sharing_key(node, ancestors)
+        if key in self.shared_styles:
+            self.num_shared += 1
+            style = self.shared_styles[key][1]
+            self.bytes_saved += self.style_sizes[id(style)]
+            return style
+
+        style = compute_style(node, self, tab, ancestors)
+        if len(self.computed_styles) >= MAX_COMPUTED_STYLES or \
+                len(self.shared_styles) >= MAX_COMPUTED_STYLES:
+            # Animating inline styles keeps making new styles; nodes
+            # hold on to the ones they use
+            self.computed_styles.clear()
+            self.style_sizes.clear()
+            self.shared_styles.clear()
+        interned_key = tuple(sorted(style.items()))
+        if interned_key in self.computed_styles:
+            self.bytes_saved += sys.getsizeof(style)
+            style = self.computed_styles[interned_key]
+        else:
+            size = sys.getsizeof(style)
+            style = types.MappingProxyType(style)
+            self.computed_styles[interned_key] = style
+            self.style_sizes[id(style)] = size
+        if key is not None:
+            self.shared_styles[key] = (parent_style, style)
+        return style
+
+    def text(self):
+        if self.num_styled == 0:
+            return ""
+        return "Style sharing: {} of {} nodes ({:.0f}%), " \
+            "{} distinct styles, {} bytes saved".format(
+                self.num_shared, self.num_styled,
+                100 * self.num_shared / self.num_styled,
+                len(self.computed_styles), self.bytes_saved)
+
+
 class TextLayout:
     def __init__(self, node, parent, previous, word):
         self.node = node
@@ -618,23 +1549,24 @@ class TextLayout:
         self.children = []
 
     def get_ascent(self, font_multiplier=1.0):
-        return self.font.getMetrics().fAscent * font_multiplier
+        return self.ascent * font_multiplier
 
     def get_descent(self, font_multiplier=1.0):
-        return self.font.getMetrics().fDescent * font_multiplier
+        return self.descent * font_multiplier
 
     def layout(self):
         self.zoom = self.parent.zoom
         self.font = font(self.node.style, self.zoom)
 
-        self.width = self.font.measureText(self.word)
+        self.width = measure_word(self.node.style, self.zoom, self.word)
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = measure_word(self.previous.node.style, self.zoom, " ")
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
 
-        self.height = linespace(self.font)
+        self.ascent, self.descent = get_metrics(self.font)
+        self.height = self.descent - self.ascent
 
     def paint(self, display_list):
         color = self.node.style["color"]
@@ -654,12 +1586,30 @@ class TextLayout:
 INPUT_WIDTH_PX = 200
 
 
+def font_key(style, zoom):
+    size = css_length(style["font-size"])[0]
+    return (device_px(size, zoom), style["font-weight"], style["font-style"])
+
+
 def font(style, zoom):
-    weight = style["font-weight"]
-    variant = style["font-style"]
-    size = float(style["font-size"][:-2])
-    font_size = device_px(size, zoom)
-    return get_font(font_size, weight, variant)
+    return get_font(*font_key(style, zoom))
+
+
+MAX_WORD_WIDTHS = 100000
+WORD_WIDTHS = {}
+
+
+def measure_word(style, zoom, word):
+    # Relayouts measure the same words in the same few fonts over and
+    # over, so skip building a font and measuring when possible
+    key = font_key(style, zoom) + (word,)
+    width = WORD_WIDTHS.get(key)
+    if width is None:
+        width = font(style, zoom).measureText(word)
+        if len(WORD_WIDTHS) >= MAX_WORD_WIDTHS:
+            WORD_WIDTHS.clear()
+        WORD_WIDTHS[key] = width
+    return width
 
 
 class EmbedLayout:
@@ -680,7 +1630,7 @@ class EmbedLayout:
         self.font = font(self.node.style, self.zoom)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = measure_word(self.previous.node.style, self.zoom, " ")
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
@@ -746,7 +1696,8 @@ class InputLayout(EmbedLayout):
         bgcolor = self.node.style.get("background-color", "transparent")
 
         if bgcolor != "transparent":
-            radius = float(self.node.style.get("border-radius", "0px")[:-2])
+            radius = css_length(
+                self.node.style.get("border-radius", "0px"))[0]
             cmds.append(DrawRRect(rect, radius, bgcolor))
 
         if self.node.tag == "input":
@@ -779,11 +1730,15 @@ class BlockLayout:
         self.parent = parent
         self.children = []
         self.previous = previous
+        self.document = parent.document
+        self.dirty = True
+        self.children_dirty = False
+        self.deferred = False
 
     def font(style, zoom):
         weight = style["font-weight"]
         variant = style["font-style"]
-        size = float(style["font-size"][:-2])
+        size = css_length(style["font-size"])[0]
         font_size = device_px(size, zoom)
         return get_font(font_size, weight, variant)
 
@@ -798,7 +1753,7 @@ class BlockLayout:
             child = child_class(node, line, self.previous_word)
         line.children.append(child)
         self.previous_word = child
-        self.cursor_x += w + font(node.style, self.zoom).measureText(" ")
+        self.cursor_x += w + measure_word(node.style, self.zoom, " ")
 
     def recurse(self, node):
         if isinstance(node, Text):
@@ -827,8 +1782,7 @@ class BlockLayout:
         self.add_inline_child(node, w, InputLayout)
 
     def word(self, node, word):
-        node_font = font(node.style, self.zoom)
-        w = node_font.measureText(word)
+        w = measure_word(node.style, self.zoom, word)
         self.add_inline_child(node, w, TextLayout, word)
 
     def image(self, node):
@@ -840,38 +1794,86 @@ class BlockLayout:
         self.add_inline_child(node, w, ImageLayout)
 
     def layout(self):
-        self.zoom = self.parent.zoom
-        self.width = self.parent.width
-        self.x = self.parent.x
-
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+
+        viewport = self.document.viewport
+        if (self.dirty or self.deferred) and viewport and \
+                y >= viewport[1] and not is_transformed(self):
+            # Below the viewport: guess the height for now and lay out
+            # for real once it scrolls near
+            if self.dirty:
+                for child in self.children:
+                    detach_layout(child)
+                self.children = []
+                self.zoom = self.parent.zoom
+                self.width = self.parent.width
+                self.x = self.parent.x
+                self.height = estimate_height(self.node, self.width, self.zoom)
+                self.dirty = False
+                self.deferred = True
+            self.y = y
+            return
 
-        mode = layout_mode(self.node)
-        if mode == "block":
-            previous = None
-            for child in self.node.children:
-                next_block = BlockLayout(child, self, previous)
-                self.children.append(next_block)
-                previous = next_block
-        else:
-            self.new_line()
-            self.recurse(self.node)
+        if self.deferred:
+            self.deferred = False
+            self.dirty = True
+        elif not self.dirty and not self.children_dirty:
+            # Nothing inside changed, so at most the block moved down
+            # or up with its siblings
+            if y != self.y:
+                shift_layout(self, y - self.y)
+            return
+
+        self.zoom = self.parent.zoom
+        self.width = self.parent.width
+        self.x = self.parent.x
+        self.y = y
+
+        if self.dirty:
+            for child in self.children:
+                detach_layout(child)
+            self.children = []
+            mode = layout_mode(self.node)
+            if mode == "block":
+                previous = None
+                for child in self.node.children:
+                    next_block = BlockLayout(child, self, previous)
+                    self.children.append(next_block)
+                    previous = next_block
+            else:
+                self.new_line()
+                self.recurse(self.node)
 
         for child in self.children:
             child.layout()
 
         self.height = sum([child.height for child in self.children])
+        self.dirty = False
+        # Deferred blocks keep the path down to them open
+        self.children_dirty = any(
+            isinstance(child, BlockLayout) and
+            (child.deferred or child.children_dirty)
+            for child in self.children)
 
     def paint(self, display_list):
+        if self.deferred:
+            return
+        viewport = self.document.viewport
+        if viewport and \
+                (self.y + self.height < viewport[0] or
+                 self.y > viewport[1]) and not is_transformed(self):
+            return
+
         cmds = []
         rect = skia.Rect.MakeLTRB(
             self.x, self.y, self.x + self.width, self.y + self.height)
         bgcolor = self.node.style.get("background-color", "transparent")
         if bgcolor != "transparent":
-            radius = float(self.node.style.get("border-radius", "0px")[:-2])
+            radius = css_length(
+                self.node.style.get("border-radius", "0px"))[0]
             cmds.append(DrawRRect(rect, radius, bgcolor))
 
         for child in self.children:
@@ -938,6 +1940,53 @@ class LineLayout:
             self.x, self.y, self.width, self.height)
 
 
+def mark_layout_dirty(node):
+    # Changes are laid out again starting from the nearest block
+    while node and not node.layout_object:
+        node = node.parent
+    if not node:
+        return
+    obj = node.layout_object
+    obj.dirty = True
+    obj = obj.parent
+    while obj and not obj.children_dirty:
+        obj.children_dirty = True
+        obj = obj.parent
+
+
+def is_transformed(layout_object):
+    # A translation on the block or any block around it can move it into
+    # the viewport, so its own position doesn't tell whether it shows
+    while layout_object:
+        if layout_object.node.style.get("transform"):
+            return True
+        layout_object = layout_object.parent
+    return False
+
+
+def estimate_height(node, width, zoom):
+    # Wrap the text assuming glyphs are about half as wide as the font
+    # size and lines about one and a half times as tall
+    area = 0
+    for descendant in tree_walk(node):
+        if isinstance(descendant, Text):
+            size = device_px(
+                css_length(descendant.style["font-size"])[0], zoom)
+            area += len(descendant.text) * size * 0.55 * size * 1.5
+    return area / width
+
+
+def detach_layout(layout_object):
+    for obj in tree_walk(layout_object):
+        if obj.node.layout_object is obj:
+            obj.node.layout_object = None
+
+
+def shift_layout(layout_object, dy):
+    for obj in tree_walk(layout_object):
+        obj.y += dy
+
+
 def device_px(css_px, zoom):
     return css_px * zoom
 
@@ -952,17 +2001,27 @@ class DocumentLayout:
         node.layout_object = self
         self.parent = None
         self.children = []
-
-    def layout(self, zoom):
+        self.document = self
+        self.zoom = None
+        self.viewport = None
+        self.children_dirty = False
+
+    def layout(self, zoom, viewport=None):
+        self.viewport = viewport
+        if zoom != self.zoom:
+            # Every length depends on the zoom
+            for child in self.children:
+                detach_layout(child)
+            self.children = [BlockLayout(self.node, self, None)]
         self.zoom = zoom
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        child = self.children[0]
 
         self.width = WIDTH - 2 * device_px(HSTEP, self.zoom)
         self.x = device_px(HSTEP, self.zoom)
         self.y = device_px(VSTEP, self.zoom)
         child.layout()
         self.height = child.height + 2 * device_px(VSTEP, self.zoom)
+        self.children_dirty = False
 
     def paint(self, display_list):
         self.children[0].paint(display_list)
@@ -976,22 +2035,77 @@ class DisplayItem:
         self.children: list[DisplayItem] = children
         self.rect = rect
         self.node = node
+        self.subtree_rect = None
+        self.compositing = None
 
     def is_paint_command(self):
         return False
 
     def needs_compositing(self):
-        return any([child.needs_compositing() for child in self.children])
+        # Display items don't change once painted, so this is only
+        # worked out once for each subtree
+        if self.compositing is None:
+            self.compositing = any(
+                child.needs_compositing() for child in self.children)
+        return self.compositing
 
     def add_composited_bounds(self, rect):
         rect.join(self.rect)
         for cmd in self.children:
             cmd.add_composited_bounds(rect)
 
+    def subtree_bounds(self):
+        # Everything this item and its children draw, in its parent's
+        # coordinates
+        if not self.subtree_rect:
+            rect = skia.Rect.MakeEmpty()
+            for cmd in self.children:
+                rect.join(cmd.subtree_bounds())
+            self.subtree_rect = skia.Rect.MakeLTRB(*self.rect)
+            self.subtree_rect.join(self.map(rect))
+        return self.subtree_rect
+
     def map(self, rect):
         return rect
 
 
+class CullStats:
+    def __init__(self):
+        self.frames = 0
+        self.commands_drawn = 0
+        self.items_culled = 0
+        self.layers_drawn = 0
+        self.layers_culled = 0
+
+    def text(self):
+        if not self.frames:
+            return ""
+        return ("Per frame: {:.0f} paint commands rastered, {:.0f} display "
+                "items culled; {:.0f} layers drawn, {:.0f} culled").format(
+            self.commands_drawn / self.frames,
+            self.items_culled / self.frames,
+            self.layers_drawn / self.frames,
+            self.layers_culled / self.frames)
+
+
+CULL_STATS = CullStats()
+
+
+def execute_children(canvas, children):
+    # Items entirely above or below the clip are skipped along with
+    # their children; at raster time the clip is a tile, or the
+    # viewport plus a margin
+    clip = canvas.getLocalClipBounds()
+    for cmd in children:
+        rect = cmd.subtree_bounds()
+        if rect.bottom() < clip.top() or rect.top() > clip.bottom():
+            CULL_STATS.items_culled += 1
+            continue
+        if cmd.is_paint_command():
+            CULL_STATS.commands_drawn += 1
+        cmd.execute(canvas)
+
+
 def absolute_bounds(display_item):
     rect = skia.Rect.MakeEmpty()
     display_item.add_composited_bounds(rect)
@@ -1129,8 +2243,7 @@ class ClipRRect(DisplayItem):
             canvas.save()
             canvas.clipRRect(self.rrect)
 
-        for cmd in self.children:
-            cmd.execute(canvas)
+        execute_children(canvas, self.children)
 
         if self.should_clip:
             canvas.restore()
@@ -1193,8 +2306,7 @@ class SaveLayer(DisplayItem):
     def execute(self, canvas):
         if self.should_save:
             canvas.saveLayer(paint=self.sk_paint)
-        for cmd in self.children:
-            cmd.execute(canvas)
+        execute_children(canvas, self.children)
         if self.should_save:
             canvas.restore()
 
@@ -1202,7 +2314,7 @@ class SaveLayer(DisplayItem):
         return SaveLayer(self.sk_paint, self.node, children, self.should_save)
 
     def needs_compositing(self):
-        return self.should_save or any([child.needs_compositing() for child in self.children])
+        return self.should_save or super().needs_compositing()
 
     def __repr__(self):
         if self.should_save:
@@ -1218,6 +2330,9 @@ class DrawCompositedLayer(DisplayItem):
 
     def execute(self, canvas):
         layer = self.composited_layer
+        if TILED_RASTER:
+            layer.draw_tiles(canvas)
+            return
         if not layer.surface:
             return
         bounds = layer.composited_bounds()
@@ -1238,8 +2353,7 @@ class Transform(DisplayItem):
             canvas.save()
             canvas.translate(x, y)
 
-        for cmd in self.children:
-            cmd.execute(canvas)
+        execute_children(canvas, self.children)
 
         if self.translation:
             canvas.restore()
@@ -1278,7 +2392,130 @@ def absolute_bounds_for_obj(obj):
     return rect
 
 
+HIT_TEST_ROW_PX = 64
+
+
+class HitTestIndex:
+    def __init__(self, entries):
+        # Entries come in paint order, so the last one hit is on top.
+        # Each is filed under every row of the page it overlaps
+        self.rows = {}
+        self.first_by_node = {}
+        for order, (rect, item) in enumerate(entries):
+            if item.node not in self.first_by_node:
+                self.first_by_node[item.node] = item
+            if rect.isEmpty():
+                continue
+            top = math.floor(rect.top() / HIT_TEST_ROW_PX)
+            bottom = math.floor(rect.bottom() / HIT_TEST_ROW_PX)
+            for row in range(top, bottom + 1):
+                self.rows.setdefault(row, []).append((order, rect, item))
+
+    def hit_test(self, x, y):
+        loc_rect = skia.Rect.MakeXYWH(x, y, 1, 1)
+        best = None
+        first_row = math.floor(y / HIT_TEST_ROW_PX)
+        last_row = math.floor((y + 1) / HIT_TEST_ROW_PX)
+        for row in range(first_row, last_row + 1):
+            for entry in reversed(self.rows.get(row, [])):
+                if entry[1].intersects(loc_rect):
+                    if not best or entry[0] > best[0]:
+                        best = entry
+                    break
+        if best:
+            return best[2]
+        return None
+
+    def first(self, node):
+        return self.first_by_node.get(node)
+
+
 SHOW_COMPOSITED_LAYER_BORDERS = False
+CULL_MARGIN_PX = HEIGHT
+TILED_RASTER = True
+TILE_SIZE_PX = 256
+TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class TileCache:
+    # Rastered tiles of the active tab's layers, least recently used
+    # first; only touched by the browser thread
+    def __init__(self, max_bytes):
+        self.tiles = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.tile_bytes = TILE_SIZE_PX * TILE_SIZE_PX * 4
+
+        self.hits = 0
+        self.misses = 0
+        self.rasters = 0
+        self.evictions = 0
+
+    def get(self, key):
+        surface = self.tiles.get(key)
+        if surface:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return surface
+
+    def put(self, key, surface):
+        self.rasters += 1
+        self.tiles[key] = surface
+        while len(self.tiles) * self.tile_bytes > self.max_bytes:
+            self.tiles.popitem(last=False)
+            self.evictions += 1
+
+    def has_room(self):
+        return (len(self.tiles) + 1) * self.tile_bytes <= self.max_bytes
+
+    def clear(self):
+        self.tiles.clear()
+
+    def text(self):
+        return ("Tile cache hits: {}, misses: {}, rasters: {}, "
+                "evictions: {}, bytes cached: {}").format(
+            self.hits, self.misses, self.rasters, self.evictions,
+            len(self.tiles) * self.tile_bytes)
+
+
+TILE_CACHE = TileCache(TILE_CACHE_BYTES)
+OVERLAP_ROW_PX = 256
+
+
+class OverlapIndex:
+    # Layer bounds by position in the layer list, each filed under every
+    # row of the page it spans; bounds only ever grow
+    def __init__(self):
+        self.rows = {}
+        self.rects = {}
+        self.spans = {}
+
+    def update(self, order, rect):
+        if rect.isEmpty():
+            return
+        self.rects[order] = rect
+        first = int(rect.top() // OVERLAP_ROW_PX)
+        last = int(rect.bottom() // OVERLAP_ROW_PX)
+        old = self.spans.get(order)
+        self.spans[order] = (first, last)
+        for row in range(first, last + 1):
+            if old and old[0] <= row <= old[1]:
+                continue
+            self.rows.setdefault(row, []).append(order)
+
+    def overlaps(self, rect, above):
+        # Whether any layer after position `above` overlaps rect
+        if rect.isEmpty():
+            return False
+        first = int(rect.top() // OVERLAP_ROW_PX)
+        last = int(rect.bottom() // OVERLAP_ROW_PX)
+        for row in range(first, last + 1):
+            for order in self.rows.get(row, []):
+                if order > above and \
+                        skia.Rect.Intersects(self.rects[order], rect):
+                    return True
+        return False
 
 
 class CompositedLayer:
@@ -1286,59 +2523,155 @@ class CompositedLayer:
         self.skia_context = skia_context
         self.surface = None
         self.display_items: list[DisplayItem] = [display_item]
+        self.composited_rect = None
+        self.absolute_rect = None
 
     def composited_bounds(self):
-        rect = skia.Rect.MakeEmpty()
-        for item in self.display_items:
-            item.add_composited_bounds(rect)
-        return rect
+        if not self.composited_rect:
+            self.composited_rect = skia.Rect.MakeEmpty()
+            for item in self.display_items:
+                item.add_composited_bounds(self.composited_rect)
+        return self.composited_rect
 
     def absolute_bounds(self):
-        rect = skia.Rect.MakeEmpty()
-        for item in self.display_items:
-            rect.join(absolute_bounds(item))
-        return rect
+        if not self.absolute_rect:
+            self.absolute_rect = skia.Rect.MakeEmpty()
+            for item in self.display_items:
+                self.absolute_rect.join(absolute_bounds(item))
+        return self.absolute_rect
 
     def add(self, display_item):
         self.display_items.append(display_item)
+        if self.composited_rect:
+            display_item.add_composited_bounds(self.composited_rect)
+        self.absolute_rect = None
+
+    def local_rect(self, rect):
+        # Undo the translations of the effects above the layer
+        effect = self.display_items[0].parent
+        while effect:
+            if isinstance(effect, Transform) and effect.translation:
+                (x, y) = effect.translation
+                rect = map_translation(rect, (-x, -y))
+            effect = effect.parent
+        return rect
 
-    def can_merge(self, display_item):
-        return display_item.parent == self.display_items[0].parent
-
-    def raster(self):
+    def make_surface(self, width, height):
+        if USE_GPU:
+            surface = skia.Surface.MakeRenderTarget(
+                self.skia_context, skia.Budgeted.kNo,
+                skia.ImageInfo.MakeN32Premul(width, height))
+            if not surface:
+                surface = skia.Surface(width, height)
+            assert surface
+            return surface
+        return skia.Surface(width, height)
+
+    def raster(self, cull_rect=None):
         bounds = self.composited_bounds()
         if bounds.isEmpty():
             return
         irect = bounds.roundOut()
 
         if not self.surface:
-            if USE_GPU:
-                self.surface = skia.Surface.MakeRenderTarget(
-                    self.skia_context, skia.Budgeted.kNo,
-                    skia.ImageInfo.MakeN32Premul(irect.width(), irect.height()))
-                if not self.surface:
-                    self.surface = skia.Surface(irect.width(), irect.height())
-                assert self.surface
-            else:
-                self.surface = skia.Surface(irect.width(), irect.height())
+            self.surface = self.make_surface(irect.width(), irect.height())
 
         canvas = self.surface.getCanvas()
         canvas.clear(skia.ColorTRANSPARENT)
         canvas.save()
         canvas.translate(-bounds.left(), -bounds.top())
-        for item in self.display_items:
-            item.execute(canvas)
+        if cull_rect:
+            canvas.clipRect(self.local_rect(cull_rect))
+        execute_children(canvas, self.display_items)
         canvas.restore()
 
         if SHOW_COMPOSITED_LAYER_BORDERS:
             draw_rect(canvas, 0, 0, irect.width() - 1,
                       irect.height() - 1, border_color="red")
 
+    def tile_key(self, i, j):
+        # The cache is cleared for every new display list, and the
+        # display list keeps its items alive, so ids aren't reused
+        return (id(self.display_items[0]), i, j)
+
+    def tile_rect(self, i, j):
+        bounds = self.composited_bounds()
+        return skia.Rect.MakeXYWH(
+            bounds.left() + i * TILE_SIZE_PX,
+            bounds.top() + j * TILE_SIZE_PX,
+            TILE_SIZE_PX, TILE_SIZE_PX)
+
+    def tiles_in(self, rect):
+        bounds = self.composited_bounds()
+        rect = skia.Rect.MakeLTRB(
+            max(rect.left(), bounds.left()), max(rect.top(), bounds.top()),
+            min(rect.right(), bounds.right()),
+            min(rect.bottom(), bounds.bottom()))
+        if rect.isEmpty():
+            return []
+        left = int((rect.left() - bounds.left()) // TILE_SIZE_PX)
+        right = math.ceil((rect.right() - bounds.left()) / TILE_SIZE_PX)
+        top = int((rect.top() - bounds.top()) // TILE_SIZE_PX)
+        bottom = math.ceil((rect.bottom() - bounds.top()) / TILE_SIZE_PX)
+        return [(i, j) for j in range(top, bottom)
+                for i in range(left, right)]
+
+    def raster_tile(self, i, j):
+        rect = self.tile_rect(i, j)
+        surface = self.make_surface(TILE_SIZE_PX, TILE_SIZE_PX)
+        canvas = surface.getCanvas()
+        canvas.clear(skia.ColorTRANSPARENT)
+        canvas.save()
+        canvas.translate(-rect.left(), -rect.top())
+        canvas.clipRect(rect)
+        execute_children(canvas, self.display_items)
+        canvas.restore()
+
+        if SHOW_COMPOSITED_LAYER_BORDERS:
+            draw_rect(canvas, 0, 0, TILE_SIZE_PX - 1,
+                      TILE_SIZE_PX - 1, border_color="red")
+        TILE_CACHE.put(self.tile_key(i, j), surface)
+        return surface
+
+    def draw_tiles(self, canvas):
+        # Tiles exposed by scrolling since the last raster are rastered
+        # here, on first use
+        for (i, j) in self.tiles_in(canvas.getLocalClipBounds()):
+            surface = TILE_CACHE.get(self.tile_key(i, j))
+            if not surface:
+                surface = self.raster_tile(i, j)
+            rect = self.tile_rect(i, j)
+            surface.draw(canvas, rect.left(), rect.top())
+
+
+def tree_walk(tree):
+    # Same pre-order as tree_to_list, without recursion and without
+    # building the whole list up front
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+def tree_filter(tree, predicate):
+    return (node for node in tree_walk(tree) if predicate(node))
+
+
+def tree_find(tree, predicate):
+    for node in tree_walk(tree):
+        if predicate(node):
+            return node
+    return None
+
+
+def elements_by_tag(tree, tag):
+    return (node for node in tree_walk(tree)
+            if isinstance(node, Element) and node.tag == tag)
+
 
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(tree_walk(tree))
     return list
 
 
@@ -1358,6 +2691,8 @@ class PseudoclassSelector:
         self.pseudoclass = pseudoclass
         self.base = base
         self.priority = self.base.priority
+        self.rightmost_tag = self.base.rightmost_tag
+        self.ancestor_tags = self.base.ancestor_tags
 
     def matches(self, node):
         if not self.base.matches(node):
@@ -1493,11 +2828,59 @@ class CSSParser:
         return rules
 
 
+MAX_CACHED_CSS_RULES = 20000
+
+
+class StyleSheetCache:
+    # Parsed rule lists by stylesheet content, shared by all tabs; the
+    # rule lists must not be modified
+    def __init__(self, max_rules):
+        self.sheets = collections.OrderedDict()
+        self.num_rules = 0
+        self.max_rules = max_rules
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.measure_parse = MeasureTime("CSS parse")
+
+    def parse(self, body):
+        key = hashlib.sha1(body.encode("utf8")).hexdigest()
+        # Parse under the lock, so that tabs loading the same stylesheet
+        # at once still parse it only once
+        self.lock.acquire(blocking=True)
+        rules = self.sheets.get(key)
+        if rules is not None:
+            self.sheets.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.measure_parse.start()
+            rules = CSSParser(body).parse()
+            self.measure_parse.stop()
+            if len(rules) <= self.max_rules:
+                self.sheets[key] = rules
+                self.num_rules += len(rules)
+                while self.num_rules > self.max_rules:
+                    _, evicted = self.sheets.popitem(last=False)
+                    self.num_rules -= len(evicted)
+        self.lock.release()
+        return rules
+
+    def text(self):
+        return "CSS parse cache hits: {}, misses: {}, rules cached: {}\n{}" \
+            .format(self.hits, self.misses, self.num_rules,
+                    self.measure_parse.text())
+
+
+CSS_PARSE_CACHE = StyleSheetCache(MAX_CACHED_CSS_RULES)
+
+
 EVENT_DISPATCH_CODE = "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
 
 
 def url_origin(url):
-    scheme_colon, _, host, _ = url.split('/', 3)
+    scheme_colon, _, host, _ = str(url).split('/', 3)
     return f'{scheme_colon}//{host}'
 
 
@@ -1545,9 +2928,8 @@ class JSContext:
 
     def querySelectorAll(self, selector_text):
         selector = CSSParser(selector_text).selector()
-        nodes = [node for node in tree_to_list(self.tab.nodes, [])
-                 if selector.matches(node)]
-        return [self.get_handle(node) for node in nodes]
+        return [self.get_handle(node)
+                for node in tree_filter(self.tab.nodes, selector.matches)]
 
     def getAttribute(self, handle, attr):
         elt = self.handle_to_node[handle]
@@ -1589,12 +2971,13 @@ class JSContext:
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        self.tab.set_needs_render()
+            self.tab.set_needs_style(child)
+        self.tab.set_needs_layout(elt)
 
     def style_set(self, handle, s):
         elt = self.handle_to_node[handle]
         elt.attributes["style"] = s
-        self.tab.set_needs_render()
+        self.tab.set_needs_style(elt)
 
     def XMLHttpRequest_send(self, method, url, body, isasync, handle):
         # Resolve URL
@@ -1679,19 +3062,27 @@ class TaskRunner:
                 task.run()
 
             self.condition.acquire(blocking=True)
-            if len(self.tasks) == 0:
+            if len(self.tasks) == 0 and not self.needs_quit:
                 self.condition.wait()
             self.condition.release()
 
     def handle_quit(self):
         print(self.tab.measure_render.text())
+        print(self.tab.measure_style.text())
+        if self.tab.rule_index:
+            print(self.tab.rule_index.text())
+        print(self.tab.measure_load.text())
+        print(self.tab.measure_first_paint.text())
+        print(self.tab.preload_text())
+        self.tab.fetcher.shutdown(wait=False, cancel_futures=True)
 
 
 class CommitData:
-    def __init__(self, url, scroll, height, display_list, composited_updates, accessibility_tree, focus):
+    def __init__(self, url, scroll, height, viewport, display_list, composited_updates, accessibility_tree, focus):
         self.url = url
         self.scroll = scroll
         self.height = height
+        self.viewport = viewport
         self.display_list = display_list
         self.composited_updates = composited_updates
         self.accessibility_tree = accessibility_tree
@@ -1716,6 +3107,7 @@ class AccessibilityNode:
         self.node = node
         self.children = []
         self.text = None
+        self.index = None
 
         if node.layout_object:
             self.bounds = absolute_bounds_for_obj(node.layout_object)
@@ -1746,9 +3138,27 @@ class AccessibilityNode:
                 self.role = "none"
 
     def build(self):
-        for child_node in self.node.children:
-            self.build_internal(child_node)
+        # Iterative, so that deep documents don't run out of stack
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            node.build_internal()
+            node.build_text()
+            pending.extend(node.children)
+
+    def build_internal(self):
+        # Nodes without a role are left out, and their children take
+        # their place
+        child_nodes = list(reversed(self.node.children))
+        while child_nodes:
+            child_node = child_nodes.pop()
+            child = AccessibilityNode(child_node)
+            if child.role != "none":
+                self.children.append(child)
+            else:
+                child_nodes.extend(reversed(child_node.children))
 
+    def build_text(self):
         if self.role == "StaticText":
             self.text = self.node.text
         elif self.role == "focusable text":
@@ -1781,15 +3191,6 @@ class AccessibilityNode:
         if is_focused(self.node):
             self.text += " is focused"
 
-    def build_internal(self, child_node):
-        child = AccessibilityNode(child_node)
-        if child.role != "none":
-            self.children.append(child)
-            child.build()
-        else:
-            for grandchild_node in child_node.children:
-                self.build_internal(grandchild_node)
-
     def intersects(self, x, y):
         if self.bounds:
             return skia.Rect.Intersects(self.bounds,
@@ -1797,13 +3198,32 @@ class AccessibilityNode:
         return False
 
     def hit_test(self, x, y):
-        nodes = [node for node in tree_to_list(self, [])
-                 if node.intersects(x, y)]
-        if nodes:
-            return nodes[-1]
+        if not self.index:
+            self.index = HitTestIndex([
+                (node.bounds, node) for node in tree_walk(self)
+                if node.bounds])
+        return self.index.hit_test(x, y)
 
 
 BROKEN_IMAGE = skia.Image.open("Broken_Image.png")
+MAX_PARALLEL_FETCHES = 8
+MAX_PENDING_CHUNKS = 2
+PENDING_CHUNK_POLL_SEC = 0.1
+PRELOAD_SCANNER = True
+LAZY_LAYOUT = True
+LAZY_LAYOUT_MARGIN_PX = HEIGHT
+PARSE_CHUNK_CHARS = 16 * 1024
+
+
+DEFAULT_STYLE_SHEET = None
+
+
+def default_style_sheet():
+    global DEFAULT_STYLE_SHEET
+    if DEFAULT_STYLE_SHEET is None:
+        with open("browser.css") as f:
+            DEFAULT_STYLE_SHEET = CSS_PARSE_CACHE.parse(f.read())
+    return DEFAULT_STYLE_SHEET
 
 
 class Tab:
@@ -1818,6 +3238,10 @@ class Tab:
         self.dark_mode = False
 
         self.needs_style = False
+        self.needs_full_style = False
+        self.rule_index = None
+        self.document = None
+        self.hit_test_index = None
         self.needs_layout = False
         self.needs_paint = False
         self.needs_focus_scroll = False
@@ -1829,22 +3253,67 @@ class Tab:
         self.task_runner.start()
 
         self.measure_render = MeasureTime("render")
+        self.measure_style = MeasureTime("style")
+        self.measure_layout = MeasureTime("layout")
+        self.measure_load = MeasureTime("load")
+        self.measure_first_paint = MeasureTime("first-paint")
+        self.load_count = 0
+        self.needs_first_paint = False
 
         self.composited_updates = []
 
-        with open("browser.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+        self.default_style_sheet = default_style_sheet()
+
+        self.fetcher = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_FETCHES)
+        self.fetch_lock = threading.Lock()
+        self.pending_fetches = {}
+        self.preloaded = set()
+        self.num_preloads = 0
+        self.num_preload_hits = 0
+
+    def fetch(self, url, preload=False):
+        key = str(url)
+        self.fetch_lock.acquire(blocking=True)
+        if key not in self.pending_fetches:
+            self.pending_fetches[key] = self.fetcher.submit(
+                url.request, self.url)
+            if preload:
+                self.preloaded.add(key)
+                self.num_preloads += 1
+        elif not preload and key in self.preloaded:
+            self.preloaded.remove(key)
+            self.num_preload_hits += 1
+        fetch = self.pending_fetches[key]
+        self.fetch_lock.release()
+        return fetch
+
+    def preload(self, load_count, src):
+        # Runs on the body reader thread, ahead of the parser
+        if load_count != self.load_count or self.task_runner.needs_quit:
+            return
+        try:
+            url = self.url.resolve(src)
+        except Exception:
+            return
+        if self.allowed_request(url):
+            self.fetch(url, preload=True)
+
+    def preload_text(self):
+        return "Preloaded {} subresources, {} used by the parser".format(
+            self.num_preloads, self.num_preload_hits)
 
     def load(self, url, body=None):
         self.focus = None
         self.zoom = 1
         self.scroll = 0
         self.scroll_changed_in_tab = True
+        self.measure_load.start()
+        self.measure_first_paint.start()
+        self.needs_first_paint = True
 
-        # Request
-        headers, body = url.request(self.url, body)
-        body = body.decode("utf8")
-        body = html.unescape(body)
+        # Request; the body is parsed while it downloads
+        headers, chunks = url.request_stream(self.url, body)
 
         self.history.append(url)
         self.url = url
@@ -1855,79 +3324,237 @@ class Tab:
             if len(csp) > 0 and csp[0] == "default-src":
                 self.allowed_origins = csp[1:]
 
-        # DOM tree
-        self.nodes = HTMLParser(body).parse()
-        # print_tree(self.nodes)
+        self.pending_fetches = {}
+        self.preloaded = set()
+        self.style_fetches = []
+        self.script_fetches = []
+        self.image_fetches = []
+        self.num_applied_styles = 0
 
-        # Load styles
         # Browser default styles
         self.rules = self.default_style_sheet.copy()
+        self.rule_index = None
+        self.js = JSContext(self)
+
+        # DOM tree, starting from an empty document until the first
+        # chunk arrives
+        self.nodes = Element("html", {}, None)
+        self.parser = HTMLParser(on_node=self.parsed_node)
+        self.body_decoder = BodyDecoder()
+        self.unparsed_text = ""
+        self.body_complete = False
+        self.parse_scheduled = False
+        self.load_count += 1
+        load_count = self.load_count
+
+        # Only a few chunks may wait in the task queue at once, so that
+        # animation frames get to paint between them
+        pending_chunks = threading.Semaphore(MAX_PENDING_CHUNKS)
+
+        preload_scanner = PreloadScanner(
+            lambda src: self.preload(load_count, src))
+
+        def abandoned():
+            return self.task_runner.needs_quit or \
+                load_count != self.load_count
+
+        def read_body():
+            try:
+                for data in chunks:
+                    if PRELOAD_SCANNER:
+                        preload_scanner.scan(data)
+                    # Nobody parses the chunks once the tab quits or
+                    # starts another load, so stop downloading them
+                    while not pending_chunks.acquire(
+                            timeout=PENDING_CHUNK_POLL_SEC):
+                        if abandoned():
+                            break
+                    if abandoned():
+                        if hasattr(chunks, "close"):
+                            chunks.close()
+                        return
+                    task = Task(self.parse_chunk, load_count,
+                                data, pending_chunks)
+                    self.task_runner.schedule_task(task)
+            except Exception as e:
+                print("Exception loading page: url=" +
+                      str(url) + " exception=" + str(e))
+            task = Task(self.end_of_body, load_count)
+            self.task_runner.schedule_task(task)
+
+        # A daemon, so that a read blocked on a slow server doesn't keep
+        # the browser from exiting
+        threading.Thread(target=read_body, daemon=True).start()
+        self.set_needs_render()
+
+    def parse_chunk(self, load_count, data, pending_chunks):
+        pending_chunks.release()
+        if load_count != self.load_count:
+            return
+        self.unparsed_text += self.body_decoder.decode(data)
+        self.schedule_parse(load_count)
+
+    def end_of_body(self, load_count):
+        if load_count != self.load_count:
+            return
+        self.unparsed_text += self.body_decoder.decode(b"", final=True)
+        self.body_complete = True
+        self.schedule_parse(load_count)
+
+    def schedule_parse(self, load_count):
+        if not self.parse_scheduled:
+            self.parse_scheduled = True
+            task = Task(self.parse_some, load_count)
+            self.task_runner.schedule_task(task)
+
+    def parse_some(self, load_count):
+        if load_count != self.load_count:
+            return
+        self.parse_scheduled = False
+
+        # Parse a bounded slice per task, so that animation frames can
+        # paint the partial document in between
+        text = self.unparsed_text[:PARSE_CHUNK_CHARS]
+        self.unparsed_text = self.unparsed_text[PARSE_CHUNK_CHARS:]
+        self.parser.feed(text)
+        if self.unparsed_text:
+            self.schedule_parse(load_count)
+        elif self.body_complete:
+            self.finish_load()
+            return
+
+        if self.parser.root():
+            self.nodes = self.parser.root()
+        self.apply_loaded_images()
+        # Paint early once, as soon as the stylesheets found so far are
+        # in; later the whole document is rendered when it finishes
+        if self.needs_first_paint and self.apply_loaded_styles():
+            self.set_needs_render()
+
+    def finish_load(self):
+        self.nodes = self.parser.close()
+        # print_tree(self.nodes)
 
         # Imported styles
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and "href" in node.attributes
-                 and node.attributes.get("rel") == "stylesheet"]
-        for link in links:
-            style_url = url.resolve(link)
-            if not self.allowed_request(style_url):
-                print("Blocked style", link, "due to CSP")
-                continue
+        concurrent.futures.wait(self.style_fetches)
+        self.apply_loaded_styles()
+
+        # Import scripts
+        for script_url, fetch in self.script_fetches:
             try:
-                header, body = url.request(style_url)
-                body = body.decode('utf8')
-            except:
+                header, body = fetch.result()
+                body = body.decode("utf8")
+            except Exception as e:
+                print("Exception loading script: url=" +
+                      str(script_url) + " exception=" + str(e))
                 continue
-            self.rules.extend(CSSParser(body).parse())
+            task = Task(self.js.run, script_url, body)
+            self.task_runner.schedule_task(task)
 
-        # Import scripts
-        scripts = [node.attributes["src"] for node in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == 'script'
-                   and 'src' in node.attributes]
+        # Import images
+        concurrent.futures.wait(
+            [fetch for img, image_url, fetch in self.image_fetches])
+        self.apply_loaded_images()
+        self.pending_fetches = {}
+        self.preloaded = set()
 
-        self.js = JSContext(self)
-        for script in scripts:
-            script_url = url.resolve(script)
+        self.measure_load.stop()
+        self.set_needs_render()
+
+    def parsed_node(self, node):
+        # Whatever renders next, such as an image arriving, has to style
+        # nodes parsed since the last render before laying them out
+        mark_style_dirty(node)
+        self.needs_style = True
+        if isinstance(node, Element):
+            self.discover_subresource(node)
+
+    def discover_subresource(self, node):
+        if node.tag == "link" and "href" in node.attributes \
+                and node.attributes.get("rel") == "stylesheet":
+            link = node.attributes["href"]
+            style_url = self.url.resolve(link)
+            if not self.allowed_request(style_url):
+                print("Blocked style", link, "due to CSP")
+                return
+            self.style_fetches.append(self.fetch(style_url))
+
+        elif node.tag == "script" and "src" in node.attributes:
+            script = node.attributes["src"]
+            script_url = self.url.resolve(script)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
-                continue
+                return
+            self.script_fetches.append((script_url, self.fetch(script_url)))
 
-            header, body = script_url.request(url)
-            body = body.decode("utf8")
-            task = Task(self.js.run, script_url, body)
-            self.task_runner.schedule_task(task)
+        elif node.tag == "img":
+            # Lay out with a placeholder until the real image arrives
+            node.image = BROKEN_IMAGE
+            src = node.attributes.get("src", "")
+            try:
+                image_url = self.url.resolve(src)
+                assert self.allowed_request(image_url), \
+                    "Blocked load of " + str(image_url) + " due to CSP"
+                self.image_fetches.append(
+                    (node, image_url, self.fetch(image_url)))
+            except Exception as e:
+                print("Exception loading image: url=" +
+                      src + " exception=" + str(e))
 
-        # Import images
-        images = [node for node in tree_to_list(self.nodes, [])
-                  if isinstance(node, Element)
-                  and node.tag == "img"]
-        for img in images:
+    def apply_loaded_styles(self):
+        if not all([fetch.done() for fetch in self.style_fetches]):
+            return False
+        for fetch in self.style_fetches[self.num_applied_styles:]:
+            try:
+                header, body = fetch.result()
+                body = body.decode('utf8')
+            except:
+                continue
+            self.rules.extend(CSS_PARSE_CACHE.parse(body))
+            self.rule_index = None
+        self.num_applied_styles = len(self.style_fetches)
+        return True
+
+    def apply_loaded_images(self):
+        pending = []
+        for img, image_url, fetch in self.image_fetches:
+            if not fetch.done():
+                pending.append((img, image_url, fetch))
+                continue
             try:
-                src = img.attributes.get("src", "")
-                image_url = url.resolve(src)
-                assert self.allowed_request(
-                    image_url), "Blocked load of " + image_url + "due to CSP"
-                header, body = image_url.request(url)
+                header, body = fetch.result()
 
                 img.encoded_data = body
                 data = skia.Data.MakeWithoutCopy(body)
                 img.image = skia.Image.MakeFromEncoded(data)
+                assert img.image, "Could not decode image"
             except Exception as e:
-                url = image_url if image_url else src
                 print("Exception loading image: url=" +
-                      str(url) + " exception=" + str(e))
+                      str(image_url) + " exception=" + str(e))
                 img.image = BROKEN_IMAGE
-
-        self.set_needs_render()
+            self.set_needs_layout(img)
+        self.image_fetches = pending
 
     def set_needs_render(self):
+        self.needs_style = True
+        self.needs_full_style = True
+        self.browser.set_needs_animation_frame(self)
+
+    def set_needs_style(self, node):
+        # Only the node is restyled, plus whichever descendants inherit
+        # a property that changed
+        mark_style_dirty(node)
         self.needs_style = True
         self.browser.set_needs_animation_frame(self)
 
-    def set_needs_layout(self):
+    def viewport(self):
+        if not LAZY_LAYOUT:
+            return None
+        return (self.scroll - LAZY_LAYOUT_MARGIN_PX,
+                self.scroll + HEIGHT - CHROME_PX + LAZY_LAYOUT_MARGIN_PX)
+
+    def set_needs_layout(self, node):
+        mark_layout_dirty(node)
         self.needs_layout = True
         self.browser.set_needs_animation_frame(self)
 
@@ -1941,16 +3568,29 @@ class Tab:
 
         self.js.interp.evaljs("__runRAFHandlers()")
 
-        for node in tree_to_list(self.nodes, []):
+        if self.document and self.document.viewport:
+            top, bottom = self.document.viewport
+            if self.scroll < top or \
+                    self.scroll + HEIGHT - CHROME_PX > bottom:
+                self.needs_layout = True
+
+        for node in tree_walk(self.nodes):
+            if not node.animations:
+                continue
             for (property_name, animation) in node.animations.items():
                 value = animation.animate()
                 if value:
-                    node.style[property_name] = value
+                    set_animated_style(node, property_name, value)
                     if property_name == "opacity":
                         self.composited_updates.append(node)
                         self.set_needs_paint()
+                    elif property_name in LAYOUT_PROPERTIES:
+                        self.set_needs_layout(node)
                     else:
-                        self.set_needs_layout()
+                        # Transforms move painted output and
+                        # accessibility bounds, but not layout
+                        self.needs_accessibility = True
+                        self.set_needs_paint()
 
         needs_composite = self.needs_style and self.needs_layout
         self.render()
@@ -1972,13 +3612,16 @@ class Tab:
         composited_updates = {}
         if not needs_composite:
             for node in self.composited_updates:
-                composited_updates[node] = node.save_layer
+                # Nodes outside the viewport weren't painted
+                if node.save_layer:
+                    composited_updates[node] = node.save_layer
         self.composited_updates.clear()
 
         commit_data = CommitData(
             url=self.url,
             scroll=scroll,
             height=document_height,
+            viewport=self.document.viewport,
             display_list=self.display_list,
             composited_updates=composited_updates,
             accessibility_tree=self.accessibility_tree,
@@ -1994,24 +3637,34 @@ class Tab:
 
         # Styling
         if self.needs_style:
+            self.measure_style.start()
             if self.dark_mode:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
                 INHERITED_PROPERTIES["color"] = "black"
-            style(self.nodes, sorted(self.rules, key=cascade_priority), self)
+            if not self.rule_index:
+                self.rule_index = RuleIndex(self.rules)
+            style(self.nodes, self.rule_index, self,
+                  force=self.needs_full_style)
             self.needs_layout = True
             self.needs_style = False
+            self.needs_full_style = False
+            self.measure_style.stop()
 
         # Layout tree
         if self.needs_layout:
-            self.document = DocumentLayout(self.nodes)
-            self.document.layout(self.zoom)
+            self.measure_layout.start()
+            if not self.document or self.document.node is not self.nodes:
+                self.document = DocumentLayout(self.nodes)
+            self.document.layout(self.zoom, self.viewport())
+            self.measure_layout.stop()
             self.needs_accessibility = True
             self.needs_paint = True
             self.needs_layout = False
             # print_tree(self.document)
 
         if self.needs_accessibility:
+            self.hit_test_index = None
             self.accessibility_tree = AccessibilityNode(self.nodes)
             self.accessibility_tree.build()
             self.needs_accessibility = False
@@ -2022,6 +3675,9 @@ class Tab:
             self.display_list = []
             self.document.paint(self.display_list)
             self.needs_paint = False
+            if self.needs_first_paint and self.nodes.children:
+                self.needs_first_paint = False
+                self.measure_first_paint.stop()
 
         self.measure_render.stop()
 
@@ -2033,9 +3689,16 @@ class Tab:
             self.needs_focus_scroll = True
         if self.focus:
             self.focus.is_focused = False
+            self.set_needs_focus_style(self.focus)
         self.focus = node
         if node:
             node.is_focused = True
+            self.set_needs_focus_style(node)
+
+    def set_needs_focus_style(self, node):
+        # :focus can also appear on the ancestor side of a selector
+        for descendant in tree_walk(node):
+            self.set_needs_style(descendant)
 
     def scroll_up(self):
         if self.scroll > 0:
@@ -2046,15 +3709,13 @@ class Tab:
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
 
     def click(self, x, y):
-        self.focus = None
+        self.focus_element(None)
         y += self.scroll
 
-        loc_rect = skia.Rect.MakeXYWH(x, y, 1, 1)
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if absolute_bounds_for_obj(obj).intersects(loc_rect)]
-        if not objs:
+        obj = self.layout_index().hit_test(x, y)
+        if not obj:
             return
-        elt = objs[-1].node
+        elt = obj.node
 
         while elt:
             if isinstance(elt, Text):
@@ -2062,7 +3723,6 @@ class Tab:
             elif is_focusable(elt):
                 self.focus_element(elt)
                 self.activate_element(elt)
-                self.set_needs_render()
                 return
             elt = elt.parent
 
@@ -2071,15 +3731,13 @@ class Tab:
             if self.js.dispatch_event("keydown", self.focus):
                 return
             self.focus.attributes["value"] += char
-            self.set_needs_render()
+            self.set_needs_style(self.focus)
 
     def submit_form(self, elt):
         if self.js.dispatch_event("submit", elt):
             return
-        inputs = [node for node in tree_to_list(elt, [])
-                  if isinstance(node, Element)
-                  and node.tag == 'input'
-                  and "name" in node.attributes]
+        inputs = [node for node in elements_by_tag(elt, "input")
+                  if "name" in node.attributes]
 
         body = ""
         for input in inputs:
@@ -2120,7 +3778,7 @@ class Tab:
 
     def advance_tab(self):
         focusable_nodes = [node
-                           for node in tree_to_list(self.nodes, [])
+                           for node in tree_walk(self.nodes)
                            if isinstance(node, Element)
                            and is_focusable(node)
                            and get_tabindex(node) >= 0]
@@ -2136,7 +3794,6 @@ class Tab:
         else:
             self.focus_element(None)
             self.browser.focus_address_bar()
-        self.set_needs_render()
 
     def enter(self):
         if not self.focus:
@@ -2157,14 +3814,24 @@ class Tab:
                     self.submit_form(elt)
                 elt = elt.parent
 
+    def layout_index(self):
+        # Built on demand, at most once per layout or transform change
+        if not self.hit_test_index:
+            self.hit_test_index = HitTestIndex([
+                (absolute_bounds_for_obj(obj), obj)
+                for obj in tree_walk(self.document)])
+        return self.hit_test_index
+
     def scroll_to(self, elt):
-        objs = [
-            obj for obj in tree_to_list(self.document, [])
-            if obj.node == self.focus
-        ]
-        if not objs:
-            return
-        obj = objs[0]
+        obj = self.layout_index().first(self.focus)
+        if not obj:
+            # Not laid out yet, so scroll to the block that will hold it
+            node = elt.parent
+            while node and not node.layout_object:
+                node = node.parent
+            if not node:
+                return
+            obj = node.layout_object
 
         content_height = HEIGHT - CHROME_PX
         if self.scroll < obj.y < self.scroll + content_height:
@@ -2180,12 +3847,50 @@ REFRESH_RATE_SEC = 0.016  # 16ms
 
 
 def add_parent_pointers(nodes, parent=None):
-    for node in nodes:
+    stack = [(node, parent) for node in nodes]
+    while stack:
+        node, parent = stack.pop()
         node.parent = parent
-        add_parent_pointers(node.children, node)
+        stack.extend((child, node) for child in node.children)
 
 
 USE_GPU = True
+PARTIAL_REDRAW = True
+
+
+class DamageStats:
+    def __init__(self):
+        self.frames = 0
+        self.damaged_area = 0
+        self.full_area = 0
+
+    def text(self):
+        if not self.frames:
+            return ""
+        return "Per frame: {:.0f} of {:.0f} pixels redrawn ({:.0%})".format(
+            self.damaged_area / self.frames, self.full_area / self.frames,
+            self.damaged_area / self.full_area)
+
+
+DAMAGE_STATS = DamageStats()
+
+
+def add_damage(damage, rect):
+    # Damage is kept as disjoint rects on the pixel grid, so that no
+    # pixel is drawn twice
+    rect = skia.Rect.Make(rect.roundOut())
+    if rect.isEmpty():
+        return
+    merged = True
+    while merged:
+        merged = False
+        for other in damage:
+            if skia.Rect.Intersects(other, rect):
+                damage.remove(other)
+                rect.join(other)
+                merged = True
+                break
+    damage.append(rect)
 
 
 class Browser:
@@ -2237,6 +3942,7 @@ class Browser:
                 )
             )
             self.chrome_surface = skia.Surface(WIDTH, CHROME_PX)
+            self.skia_context = None
 
         self.tabs: list[Tab] = []
         self.active_tab: int = None
@@ -2252,6 +3958,7 @@ class Browser:
         self.scroll = 0
 
         self.active_tab_height = 0
+        self.active_tab_viewport = None
         self.active_tab_display_list: list[DisplayItem] = None
         self.tab_focus = None
         self.last_tab_focus = None
@@ -2262,6 +3969,15 @@ class Browser:
         self.composited_updates = {}
         self.composited_layers = []
         self.draw_list = []
+        self.composited_rect = None
+        self.composited_display_list = None
+
+        # Window damage, and tab damage in page coordinates, since the
+        # last draw
+        self.damage = []
+        self.tab_damage = []
+        self.drawn_scroll = None
+        self.drawn_outline = None
 
         self.needs_accessibility = False
         self.accessibility_is_on = False
@@ -2314,6 +4030,7 @@ class Browser:
         self.active_tab = index
         self.scroll = 0
         self.url = None
+        add_damage(self.damage, self.tab_rect())
         self.needs_animation_frame = True
 
     def schedule_load_tab(self, url, body=None):
@@ -2366,11 +4083,15 @@ class Browser:
             return
 
         self.measure_composite_raster_and_draw.start()
+        CULL_STATS.frames += 1
         if self.needs_composite:
             self.composite()
         if self.needs_raster:
             self.raster_chrome()
             self.raster_tab()
+        elif self.needs_draw and TILED_RASTER:
+            # Scrolling may have exposed tiles that aren't rastered yet
+            self.raster_tab()
         if self.needs_draw:
             self.paint_draw_list()
             self.draw()
@@ -2385,11 +4106,48 @@ class Browser:
 
         self.lock.release()
 
+    def visible_rect(self):
+        return skia.Rect.MakeLTRB(
+            0, self.scroll, WIDTH, self.scroll + HEIGHT - CHROME_PX)
+
+    def cull_rect(self):
+        # Also keep what is a short scroll away, so that scrolling
+        # doesn't have to composite again right away
+        return self.visible_rect().makeOutset(0, CULL_MARGIN_PX)
+
     def raster_tab(self):
+        if TILED_RASTER:
+            self.raster_tiles()
+            return
+        cull_rect = self.cull_rect()
         for composited_layer in self.composited_layers:
-            composited_layer.raster()
+            if composited_layer.absolute_bounds().intersects(cull_rect):
+                composited_layer.raster(cull_rect)
+
+    def raster_tiles(self):
+        # Visible tiles first, then the ones a short scroll away,
+        # nearest first, for as long as they fit without evicting any
+        visible_rect = self.visible_rect()
+        cull_rect = self.cull_rect()
+        prefetch = []
+        for layer in self.composited_layers:
+            visible = layer.local_rect(visible_rect)
+            for (i, j) in layer.tiles_in(visible):
+                if not TILE_CACHE.get(layer.tile_key(i, j)):
+                    layer.raster_tile(i, j)
+            for (i, j) in layer.tiles_in(layer.local_rect(cull_rect)):
+                if layer.tile_key(i, j) not in TILE_CACHE.tiles:
+                    distance = abs(layer.tile_rect(i, j).centerY() -
+                                   visible.centerY())
+                    prefetch.append((distance, layer, i, j))
+        prefetch.sort(key=lambda tile: tile[0])
+        for (_, layer, i, j) in prefetch:
+            if not TILE_CACHE.has_room():
+                break
+            layer.raster_tile(i, j)
 
     def raster_chrome(self):
+        add_damage(self.damage, skia.Rect.MakeLTRB(0, 0, WIDTH, CHROME_PX))
         canvas = self.chrome_surface.getCanvas()
         if self.dark_mode:
             color = "white"
@@ -2400,13 +4158,13 @@ class Browser:
         canvas.clear(parse_color(background_color))
 
         # Plus button to add a tab
-        buttonfont = skia.Font(skia.Typeface('Arial'), 30)
+        buttonfont = get_font(30, "normal", "roman")
         draw_rect(canvas, 10, 10, 30, 30,
                   fill_color=background_color, border_color=color)
         draw_text(canvas, 11, 4, "+", buttonfont, color)
 
         # Draw tabs
-        tabfont = skia.Font(skia.Typeface('Arial'), 20)
+        tabfont = get_font(20, "normal", "roman")
         for i, tab in enumerate(self.tabs):
             name = f"Tab {i}"
             x1, x2 = 40 + 80 * i, 120 + 80 * i
@@ -2437,26 +4195,48 @@ class Browser:
         canvas.drawPath(path, paint)
 
     def composite(self):
+        if self.active_tab_display_list is not self.composited_display_list:
+            # Nothing rastered or drawn for the old display list holds
+            self.composited_display_list = self.active_tab_display_list
+            TILE_CACHE.clear()
+            add_damage(self.damage, self.tab_rect())
+        elif not TILED_RASTER:
+            # Layers cut to a new cull rect can land on different pixels
+            add_damage(self.damage, self.tab_rect())
         self.composited_layers = []
         add_parent_pointers(self.active_tab_display_list)
         all_commands = []
         for cmd in self.active_tab_display_list:
-            all_commands = tree_to_list(cmd, all_commands)
+            all_commands.extend(tree_walk(cmd))
 
         non_composited_commands = [cmd for cmd in all_commands if not cmd.needs_compositing()
                                    and (not cmd.parent or cmd.parent.needs_compositing())]
+        # Cached tiles outlive a composite, so with tiling the layers
+        # mustn't depend on the scroll position
+        if not TILED_RASTER:
+            self.composited_rect = self.cull_rect()
+        # Same as walking the layers from the top down, merging into the
+        # first one whose items share cmd's parent, unless another layer
+        # overlaps cmd before that
+        last_layer_by_parent = {}
+        overlap_index = OverlapIndex()
         for cmd in non_composited_commands:
-            for layer in reversed(self.composited_layers):
-                if layer.can_merge(cmd):
-                    layer.add(cmd)
-                    break
-                elif skia.Rect.Intersects(layer.composited_bounds(), absolute_bounds(cmd)):
-                    layer = CompositedLayer(self.skia_context, cmd)
-                    self.composited_layers.append(layer)
-                    break
+            bounds = absolute_bounds(cmd)
+            if self.composited_rect and \
+                    not bounds.intersects(self.composited_rect):
+                CULL_STATS.items_culled += 1
+                continue
+            order = last_layer_by_parent.get(cmd.parent)
+            if order is not None and \
+                    not overlap_index.overlaps(bounds, order):
+                layer = self.composited_layers[order]
+                layer.add(cmd)
             else:
                 layer = CompositedLayer(self.skia_context, cmd)
                 self.composited_layers.append(layer)
+                order = len(self.composited_layers) - 1
+                last_layer_by_parent[cmd.parent] = order
+            overlap_index.update(order, layer.composited_bounds())
 
     def clone_latest(self, visual_effect, current_effect):
         node = visual_effect.node
@@ -2469,10 +4249,19 @@ class Browser:
 
     def paint_draw_list(self):
         self.draw_list = []
+        visible_rect = self.visible_rect()
         for composited_layer in self.composited_layers:
-            current_effect = DrawCompositedLayer(composited_layer)
             if not composited_layer.display_items:
                 continue
+            if not composited_layer.absolute_bounds().intersects(
+                    visible_rect):
+                CULL_STATS.layers_culled += 1
+                continue
+            if not TILED_RASTER and not composited_layer.surface:
+                # Skipped at raster time, but scrolled into view since
+                composited_layer.raster(self.cull_rect())
+            CULL_STATS.layers_drawn += 1
+            current_effect = DrawCompositedLayer(composited_layer)
             parent = composited_layer.display_items[0].parent
             while parent:
                 current_effect = self.clone_latest(parent, [current_effect])
@@ -2493,50 +4282,126 @@ class Browser:
             self.draw_list.append(DrawOutline(
                 self.hovered_a11y_node.bounds,
                 "white" if self.dark_mode else "black", 2))
-
-    def draw(self):
-        canvas = self.root_surface.getCanvas()
-        # Clear all
-        if self.dark_mode:
-            canvas.clear(skia.ColorBLACK)
+        outline = self.hovered_a11y_node and self.hovered_a11y_node.bounds
+        if outline != self.drawn_outline:
+            for rect in [outline, self.drawn_outline]:
+                if rect:
+                    add_damage(self.tab_damage, rect.makeOutset(2, 2))
+            self.drawn_outline = outline
+
+    def tab_rect(self):
+        return skia.Rect.MakeLTRB(0, CHROME_PX, WIDTH, HEIGHT)
+
+    def take_damage(self):
+        damage = self.damage
+        if not PARTIAL_REDRAW or USE_GPU or self.drawn_scroll is None:
+            # Swapped GPU buffers don't keep the last frame around
+            damage = [skia.Rect.MakeWH(WIDTH, HEIGHT)]
         else:
-            canvas.clear(skia.ColorWHITE)
+            tab_rect = self.tab_rect()
+            dy = self.scroll - self.drawn_scroll
+            if dy != int(dy) or abs(dy) >= tab_rect.height():
+                add_damage(damage, tab_rect)
+            elif dy:
+                # Move what stays on screen instead of drawing it again
+                top = CHROME_PX + max(dy, 0)
+                kept = skia.IRect.MakeLTRB(
+                    0, int(top), WIDTH, int(HEIGHT + min(dy, 0)))
+                snapshot = self.root_surface.makeImageSnapshot(kept)
+                self.root_surface.getCanvas().drawImage(
+                    snapshot, 0, top - dy)
+                if dy > 0:
+                    exposed = skia.Rect.MakeLTRB(0, HEIGHT - dy, WIDTH, HEIGHT)
+                else:
+                    exposed = skia.Rect.MakeLTRB(
+                        0, CHROME_PX, WIDTH, CHROME_PX - dy)
+                add_damage(damage, exposed)
+            for rect in self.tab_damage:
+                rect = rect.makeOffset(0, CHROME_PX - self.scroll)
+                if rect.intersect(tab_rect):
+                    add_damage(damage, rect)
+        self.damage = []
+        self.tab_damage = []
+        self.drawn_scroll = self.scroll
+        return damage
+
+    def damage_composited_updates(self):
+        for layer in self.composited_layers:
+            effect = layer.display_items[0].parent
+            while effect:
+                if effect.node in self.composited_updates:
+                    add_damage(self.tab_damage, layer.absolute_bounds())
+                    break
+                effect = effect.parent
 
-        # Tab canvas
-        canvas.save()
-        canvas.translate(0, CHROME_PX - self.scroll)
-        for item in self.draw_list:
-            item.execute(canvas)
-        canvas.restore()
+    def draw(self):
+        scrolled = self.drawn_scroll is not None and \
+            self.scroll != self.drawn_scroll
+        damage = self.take_damage()
+        DAMAGE_STATS.frames += 1
+        DAMAGE_STATS.full_area += WIDTH * HEIGHT
+        if not damage:
+            return
 
-        # Chrome canvas
+        canvas = self.root_surface.getCanvas()
+        tab_rect = self.tab_rect()
         chrome_rect = skia.Rect.MakeLTRB(0, 0, WIDTH, CHROME_PX)
-        canvas.save()
-        canvas.clipRect(chrome_rect)
-        self.chrome_surface.draw(canvas, 0, 0)
-        canvas.restore()
+        bounds = skia.Rect.MakeEmpty()
+        for rect in damage:
+            DAMAGE_STATS.damaged_area += rect.width() * rect.height()
+            bounds.join(rect)
+            canvas.save()
+            canvas.clipRect(rect)
+            # Clear all
+            if self.dark_mode:
+                canvas.clear(skia.ColorBLACK)
+            else:
+                canvas.clear(skia.ColorWHITE)
+
+            # Tab canvas
+            if rect.intersects(tab_rect):
+                canvas.save()
+                canvas.clipRect(tab_rect)
+                canvas.translate(0, CHROME_PX - self.scroll)
+                for item in self.draw_list:
+                    item.execute(canvas)
+                canvas.restore()
+
+            # Chrome canvas
+            if rect.intersects(chrome_rect):
+                canvas.save()
+                canvas.clipRect(chrome_rect)
+                self.chrome_surface.draw(canvas, 0, 0)
+                canvas.restore()
+            canvas.restore()
 
         if USE_GPU:
             self.root_surface.flushAndSubmit()
             sdl2.SDL_GL_SwapWindow(self.sdl_window)
         else:
-            # This makes an image interface to the Skia surface, but
-            # doesn't actually copy anything yet.
-            skia_image = self.root_surface.makeImageSnapshot()
+            # Moved pixels need copying to the window too
+            if scrolled:
+                bounds.join(tab_rect)
+            # This makes an image interface to the changed part of the
+            # Skia surface, but doesn't actually copy anything yet.
+            irect = bounds.roundOut()
+            skia_image = self.root_surface.makeImageSnapshot(irect)
             skia_bytes = skia_image.tobytes()
 
             depth = 32  # Bits per pixel
-            pitch = 4 * WIDTH  # Bytes per row
+            pitch = 4 * irect.width()  # Bytes per row
             sdl_surface = sdl2.SDL_CreateRGBSurfaceFrom(
-                skia_bytes, WIDTH, HEIGHT, depth, pitch,
+                skia_bytes, irect.width(), irect.height(), depth, pitch,
                 self.RED_MASK, self.GREEN_MASK, self.BLUE_MASK, self.ALPHA_MASK
             )
 
-            rect = sdl2.SDL_Rect(0, 0, WIDTH, HEIGHT)
+            src_rect = sdl2.SDL_Rect(0, 0, irect.width(), irect.height())
+            rect = sdl2.SDL_Rect(irect.left(), irect.top(),
+                                 irect.width(), irect.height())
             window_surface = sdl2.SDL_GetWindowSurface(self.sdl_window)
             # SDL_BlitSurface does the actual copy
-            sdl2.SDL_BlitSurface(sdl_surface, rect, window_surface, rect)
-            sdl2.SDL_UpdateWindowSurface(self.sdl_window)
+            sdl2.SDL_BlitSurface(sdl_surface, src_rect, window_surface, rect)
+            sdl2.SDL_UpdateWindowSurfaceRects(self.sdl_window, rect, 1)
 
     def commit(self, tab, data):
         self.lock.acquire(blocking=True)
@@ -2545,6 +4410,7 @@ class Browser:
             if data.scroll != None:
                 self.scroll = data.scroll
             self.active_tab_height = data.height
+            self.active_tab_viewport = data.viewport
             if data.display_list:
                 self.active_tab_display_list = data.display_list
             self.animation_timer = None
@@ -2554,10 +4420,25 @@ class Browser:
                 self.composited_updates = {}
                 self.set_needs_composite()
             else:
+                self.damage_composited_updates()
                 self.set_needs_draw()
             self.accessibility_tree = data.accessibility_tree
+            self.check_viewport()
         self.lock.release()
 
+    def check_viewport(self):
+        if self.composited_rect and \
+                not self.composited_rect.contains(self.visible_rect()):
+            self.set_needs_composite()
+
+        # The tab only laid out and painted around the old scroll
+        # position, so ask for a frame before running off the end
+        if not self.active_tab_viewport:
+            return
+        top, bottom = self.active_tab_viewport
+        if self.scroll < top or self.scroll + HEIGHT - CHROME_PX > bottom:
+            self.needs_animation_frame = True
+
     def increment_zoom(self, increment):
         active_tab = self.tabs[self.active_tab]
         task = Task(active_tab.zoom_by, increment)
@@ -2594,6 +4475,7 @@ class Browser:
             self.active_tab_height
         )
         self.scroll = scroll
+        self.check_viewport()
         self.set_needs_draw()
         self.lock.release()
 
@@ -2608,6 +4490,7 @@ class Browser:
             self.active_tab_height
         )
         self.scroll = scroll
+        self.check_viewport()
         self.set_needs_draw()
         self.lock.release()
 
@@ -2660,11 +4543,19 @@ class Browser:
             active_tab = self.tabs[self.active_tab]
             task = Task(active_tab.click, e.x, e.y - CHROME_PX)
             active_tab.task_runner.schedule_task(task)
-        self.draw()
+        self.set_needs_draw()
         self.lock.release()
 
     def handle_quit(self):
         print(self.measure_composite_raster_and_draw.text())
+        print(CULL_STATS.text())
+        print(TILE_CACHE.text())
+        print(DAMAGE_STATS.text())
+        print(CONNECTION_POOL.text())
+        print(HTTP_CACHE.text())
+        print(CSS_PARSE_CACHE.text())
+        CONNECTION_POOL.close_all()
+        HTTP_CACHE.flush()
         self.tabs[self.active_tab].task_runner.set_needs_quit()
         if USE_GPU:
             sdl2.SDL_GL_DeleteContext(self.gl_context)
@@ -2672,6 +4563,7 @@ class Browser:
 
     def toggle_dark_mode(self):
         self.dark_mode = not self.dark_mode
+        add_damage(self.damage, skia.Rect.MakeWH(WIDTH, HEIGHT))
         active_tab = self.tabs[self.active_tab]
         task = Task(active_tab.toggle_dark_mode)
         active_tab.task_runner.schedule_task(task)
@@ -2687,7 +4579,9 @@ class Browser:
         self.url = None
         self.display_list = []
         self.composited_layers = []
+        self.composited_rect = None
         self.accessibility_tree = None
+        add_damage(self.damage, self.tab_rect())
 
     def focus_address_bar(self):
         self.lock.acquire(blocking=True)
@@ -2720,34 +4614,28 @@ class Browser:
             self.speak_document()
             self.has_spoken_document = True
 
-        self.active_alerts = [
-            node for node in tree_to_list(
-                self.accessibility_tree, [])
-            if node.role == "alert"
-        ]
+        self.active_alerts = list(tree_filter(
+            self.accessibility_tree, lambda node: node.role == "alert"))
         for alert in self.active_alerts:
             if alert not in self.spoken_alerts:
                 self.speak_node(alert, "New alert")
                 self.spoken_alerts.append(alert)
         new_spoken_alerts = []
         for old_node in self.spoken_alerts:
-            new_nodes = [
-                node for node in tree_to_list(
-                    self.accessibility_tree, [])
-                if node.node == old_node.node
-                and node.role == "alert"
-            ]
-            if new_nodes:
-                new_spoken_alerts.append(new_nodes[0])
+            new_node = tree_find(
+                self.accessibility_tree,
+                lambda node: node.node == old_node.node
+                and node.role == "alert")
+            if new_node:
+                new_spoken_alerts.append(new_node)
         self.spoken_alerts = new_spoken_alerts
 
         if self.tab_focus and \
                 self.tab_focus != self.last_tab_focus:
-            nodes = [node for node in tree_to_list(
-                self.accessibility_tree, [])
-                if node.node == self.tab_focus]
-            if nodes:
-                self.focus_a11y_node = nodes[0]
+            node = tree_find(self.accessibility_tree,
+                             lambda node: node.node == self.tab_focus)
+            if node:
+                self.focus_a11y_node = node
                 self.speak_node(
                     self.focus_a11y_node, "element focused ")
             self.last_tab_focus = self.tab_focus
@@ -2758,8 +4646,7 @@ class Browser:
 
     def speak_document(self):
         text = "Here are the document contents: "
-        tree_list = tree_to_list(self.accessibility_tree, [])
-        for accessibility_node in tree_list:
+        for accessibility_node in tree_walk(self.accessibility_tree):
             new_text = accessibility_node.text
             if new_text:
                 text += "\n" + new_text
@@ -2785,8 +4672,6 @@ class Browser:
 
 
 if __name__ == "__main__":
-    import sys
-
     sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
     browser = Browser()
     print(sys.argv)
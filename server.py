@@ -1,6 +1,9 @@
+import gzip
+import hashlib
 import html
 import random
 import socket
+import threading
 import urllib.parse
 from datetime import datetime
 
@@ -173,9 +176,28 @@ def log_request(method, url, status):
     print(f'[{now_str}] "{method} {url}" {status}')
 
 
+KEEP_ALIVE_TIMEOUT_SEC = 60
+STATIC_MAX_AGE_SEC = 60
+GZIP_MIN_BYTES = 1024
+
+
 def handle_connection(conx):
+    conx.settimeout(KEEP_ALIVE_TIMEOUT_SEC)
     req = conx.makefile("b")
+    while True:
+        try:
+            keep_alive = handle_request(conx, req)
+        except (socket.timeout, ConnectionError):
+            keep_alive = False
+        if not keep_alive:
+            break
+    conx.close()
+
+
+def handle_request(conx, req):
     reqline = req.readline().decode('utf8')
+    if not reqline:
+        return False
     method, url, version = reqline.split(" ", 2)
     assert method in ["GET", "POST"]
 
@@ -198,22 +220,39 @@ def handle_connection(conx):
     else:
         token = str(random.random())[2:]
 
+    keep_alive = version.strip() == "HTTP/1.1" and \
+        headers.get("connection", "").lower() != "close"
+
     session = SESSIONS.setdefault(token, {})
     status, body = do_request(session, method, url, headers, body)
+
+    etag = '"' + hashlib.sha1(body.encode('utf8')).hexdigest() + '"'
+    if status == "200 OK" and headers.get("if-none-match") == etag:
+        status, body = "304 Not Modified", ""
     log_request(method, url, status)
 
-    response = f'HTTP/1.0 {status}\r\n'
-    length = len(body.encode("utf8"))
-    response += f'Content-Length: {length}\r\n'
+    if keep_alive:
+        response = f'HTTP/1.1 {status}\r\n'
+    else:
+        response = f'HTTP/1.0 {status}\r\n'
+    body = body.encode("utf8")
+    if "gzip" in headers.get("accept-encoding", "") and \
+            len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        response += 'Content-Encoding: gzip\r\n'
+    response += f'Content-Length: {len(body)}\r\n'
     if 'cookie' not in headers:
         response += f'Set-Cookie: token={token}; SameSite=Lax\r\n'
+    response += f'ETag: {etag}\r\n'
+    if url.endswith(".js") or url.endswith(".css"):
+        response += f'Cache-Control: max-age={STATIC_MAX_AGE_SEC}\r\n'
     csp = "default-src http://localhost:8000"
     response += f"Content-Security-Policy: {csp}\r\n"
 
-    response += f'\r\n{body}'
+    response += '\r\n'
 
-    conx.send(response.encode('utf8'))
-    conx.close()
+    conx.sendall(response.encode('utf8') + body)
+    return keep_alive
 
 
 PORT = 8000
@@ -230,4 +269,4 @@ if __name__ == '__main__':
 
     while True:
         conx, addr = s.accept()
-        handle_connection(conx)
+        threading.Thread(target=handle_connection, args=(conx,)).start()